@@ -0,0 +1,713 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2020 - , puxxustc
+
+'''
+lib_dbs 性能测试, 使用随机生成的基金数据
+
+    ./bench_dbs.py save
+    ./bench_dbs.py filter --sizes 10000
+    ./bench_dbs.py compile --sizes 100000
+    ./bench_dbs.py columns --sizes 10000
+    ./bench_dbs.py series --days 3650
+    ./bench_dbs.py chunks --days 5000
+    ./bench_dbs.py cache --count 2000
+    ./bench_dbs.py project --sizes 10000
+    ./bench_dbs.py order --sizes 12000
+    ./bench_dbs.py ensure --sizes 2000,8000
+    ./bench_dbs.py bulk --sizes 10000
+    ./bench_dbs.py delete --sizes 4000
+    ./bench_dbs.py parallel --sizes 4000 --days 2500
+    ./bench_dbs.py threads --sizes 4000 --count 50
+    ./bench_dbs.py behind --sizes 2000
+    ./bench_dbs.py backends --sizes 4000
+    ./bench_dbs.py compress --sizes 2000 --days 2500
+    ./bench_dbs.py ngram --sizes 20000
+    ./bench_dbs.py readahead --sizes 4000 --days 2500
+    ./bench_dbs.py querycache --sizes 10000
+    ./bench_dbs.py views --sizes 10000
+'''
+
+import argparse
+import multiprocessing.dummy
+import os
+import tracemalloc
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import msgpack
+
+import lib_dbs
+from lib_dbs import BACKENDS, Table, get_key
+from lib_filter import parse_filter
+
+
+# 与 lib_fund_db 相同的索引, 不直接导入以免打开 data/fund.ldb
+INDEXES = [
+    'name',
+    'fullname',
+    'kind',
+    'days',
+    'nav_date_text',
+    'is_nav_abnormal_change',
+    'trace_object',
+    'max_manager_work_days',
+    'managers',
+    'total_asset_history',
+    'asset_allocation_stock',
+    'asset_allocation_cb',
+    'aror.1y',
+    'aror.2y',
+    'aror.3y',
+    'aror.4y',
+    'ror.2015_yet',
+    'ror.2015_2019',
+    'ror.2017_2019',
+    'ror.2019_yet',
+    'mdd.2020',
+    'mdd.2019',
+    'mdd.2018',
+]
+NGRAM_INDEXES = ['name', 'fullname', 'managers']
+HEAVY_KEYS = ['raw', 'navs', 'adjnavs', '7d_aror']
+SERIES_KEYS = ['navs', 'adjnavs']
+
+
+def make_fund(i, days=1000, seed=None):
+    rnd = random.Random(i if seed is None else seed)
+    code = '%06d' % i
+    ts = 1262275200000
+    value = 1.0
+    navs = []
+    for _ in range(days):
+        change = rnd.gauss(0, 1)
+        value *= 1 + change / 100
+        navs.append([ts, value, change])
+        ts += 24 * 3600 * 1000
+    return {
+        'code': code,
+        'name': rnd.choice(['国开', '中证', '沪深', '纯债', '信用']) + '债券%s' % rnd.choice('ABC'),
+        'fullname': '%s基金%d' % (rnd.choice(['易方达', '广发', '华夏', '南方']), i),
+        'kind': rnd.choice(['债券型', '混合型', '股票型', '指数型']),
+        'days': rnd.randint(30, 5000),
+        'nav_date_text': '2020-10-%02d' % rnd.randint(1, 30),
+        'is_nav_abnormal_change': rnd.random() < 0.05,
+        'max_manager_work_days': rnd.randint(0, 3000),
+        'managers': rnd.sample(['张三', '李四', '王五', '赵六', '张七'], rnd.randint(0, 2)),
+        'asset_allocation_stock': rnd.uniform(0, 100),
+        'aror': {k: rnd.uniform(-20, 40) for k in ['1y', '2y', '3y'] if rnd.random() < 0.9},
+        'ror': {'2015_yet': rnd.uniform(-50, 200), '2019_yet': rnd.uniform(-20, 80)},
+        'mdd': {k: rnd.uniform(0, 40) for k in ['2020', '2019', '2018'] if rnd.random() < 0.8},
+        'navs': navs,
+        'adjnavs': navs,
+        'raw': {'Data_netWorthTrend': navs},
+    }
+
+
+def make_table(path, name='Fund', **kwargs):
+    kwargs.setdefault('ngram_indexes', NGRAM_INDEXES)
+    return Table(os.path.join(path, 'bench.ldb'), name, 'code', INDEXES, HEAVY_KEYS, SERIES_KEYS, **kwargs)
+
+
+def bench_save(options):
+    '''单条 save() 的耗时与表的大小无关'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        n = 0
+        for size in options['sizes']:
+            for i in range(n, size):
+                table.save(make_fund(i, days=options['days']))
+            n = size
+            start = time.time()
+            for i in range(options['count']):
+                table.save(make_fund(i, days=options['days'], seed=size + i))
+            cost = (time.time() - start) / options['count']
+            print('save  size=%-6d %.3f ms/item' % (size, cost * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+SCREENS = [
+    'aror.1y > 35',
+    'days > 4900',
+    'kind == "债券型", mdd.2019 < 1',
+    'name ~ "国开", days > 1000',
+    'days > 1000',
+]
+
+
+def bench_filter(options):
+    '''常用筛选条件的耗时, warm 为重复执行 (使用缓存的索引和查询结果) 的耗时'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        for size in options['sizes']:
+            for i in range(len(table.list_pk()), size):
+                table.save(make_fund(i, days=options['days']))
+            table.analyze()
+            for screen in SCREENS:
+                q = parse_filter(screen)
+                table._clear_cache()
+                start = time.time()
+                count = len(table.filter(q, shallow=True).list())
+                cost_cold = time.time() - start
+                start = time.time()
+                count = len(table.filter(q, shallow=True).list())
+                cost_warm = time.time() - start
+                print('filter  size=%-6d cold %8.1f ms  warm %8.1f ms  %5d  %s' % (
+                    size, cost_cold * 1000, cost_warm * 1000, count, screen))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_compile(options):
+    '''Q.match() 与 Q.compile() 逐条匹配的耗时'''
+    size = max(options['sizes'])
+    funds = [make_fund(i, days=0) for i in range(size)]
+    for screen in SCREENS:
+        q = parse_filter(screen)
+        start = time.time()
+        count = sum((1 for i in funds if q.match(i)))
+        cost_match = time.time() - start
+        match = q.compile()
+        start = time.time()
+        count = sum((1 for i in funds if match(i)))
+        cost_compile = time.time() - start
+        print('compile  size=%-6d match %7.1f ms  compile %7.1f ms  %5d  %s' % (
+            size, cost_match * 1000, cost_compile * 1000, count, screen))
+
+
+def bench_columns(options):
+    '''在索引上逐条匹配与在索引列上向量化计算的耗时'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        size = max(options['sizes'])
+        for i in range(size):
+            table.save(make_fund(i, days=0))
+        pkvals = table.list_pk()
+        for screen in SCREENS:
+            q = parse_filter(screen)
+            keys = {table.index_field(i) for i in q.keys()}
+            start = time.time()
+            rows = table.load_index_rows(keys)
+            match = q.compile()
+            count = sum((1 for i in pkvals if match(rows.get(i, {}))))
+            cost_rows = time.time() - start
+            table._clear_cache()
+            start = time.time()
+            table.eval_columns(q)
+            cost_cold = time.time() - start
+            start = time.time()
+            count = table.eval_columns(q).sum()
+            cost_warm = time.time() - start
+            print('columns  size=%-6d rows %7.1f ms  cold %7.1f ms  warm %6.2f ms  %5d  %s' % (
+                size, cost_rows * 1000, cost_cold * 1000, cost_warm * 1000, count, screen))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_series(options):
+    '''净值序列以 msgpack 列表和结构化数组保存时的解码耗时与内存占用'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        fund = make_fund(0, days=options['days'])
+        data = {k: fund[k] for k in SERIES_KEYS}
+        formats = [
+            ('list', msgpack.packb(data), msgpack.unpackb),
+            ('array', table._pack_data(dict(data)), table._unpack_data),
+        ]
+        for name, packed, unpack in formats:
+            start = time.time()
+            for _ in range(options['count']):
+                unpack(packed)
+            cost = (time.time() - start) / options['count']
+            tracemalloc.start()
+            item = unpack(packed)
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del item
+            print('series  days=%-5d %-5s %8d bytes  decode %7.3f ms  memory %8d bytes' % (
+                options['days'], name, len(packed), cost * 1000, memory))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_chunks(options):
+    '''读取完整记录与只读取最近一年净值的耗时'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        fund = make_fund(0, days=options['days'])
+        table.save(fund)
+        start_ms = fund['adjnavs'][-1][0] - 365 * 24 * 3600 * 1000
+        tests = [
+            ('get_by_pk', lambda: table.get_by_pk(fund['code'])['adjnavs']),
+            ('get_series', lambda: table.get_series(fund['code'], 'adjnavs', start=start_ms)),
+        ]
+        for name, func in tests:
+            start = time.time()
+            for _ in range(options['count']):
+                series = func()
+            cost = (time.time() - start) / options['count']
+            print('chunks  days=%-5d %-10s %7.3f ms  %5d rows' % (options['days'], name, cost * 1000, len(series)))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_cache(options):
+    '''开启记录缓存前后重复读取记录的耗时 (先完整读取一遍预热)'''
+    path = tempfile.mkdtemp()
+    try:
+        size = max(options['sizes'])
+        for cache_items in (0, size):
+            table = make_table(path, cache_items=cache_items)
+            for i in range(len(table.list_pk()), size):
+                table.save(make_fund(i, days=options['days']))
+            pkvals = table.list_pk()
+            rnd = random.Random(0)
+            picks = [rnd.choice(pkvals) for _ in range(options['count'])]
+            for shallow in (True, False):
+                for pkval in pkvals:
+                    table.get_by_pk(pkval, shallow=shallow)
+                start = time.time()
+                for pkval in picks:
+                    table.get_by_pk(pkval, shallow=shallow)
+                cost = (time.time() - start) / options['count']
+                print('cache  size=%-6d items=%-6d shallow=%-5s %7.3f ms/item  %s' % (
+                    size, cache_items, shallow, cost * 1000, table.cache_info()))
+            table._db.db.close()
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_project(options):
+    '''count() 和 list_field() 读取记录与只读取索引的耗时'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        size = max(options['sizes'])
+        for i in range(size):
+            table.save(make_fund(i, days=0))
+        table.analyze()
+        for screen in SCREENS:
+            qs = table.filter(parse_filter(screen), shallow=True)
+            tests = [
+                ('count', lambda: len(list(qs)), qs.count),
+                ('name', lambda: [i['name'] for i in qs], lambda: qs.list_field('name')),
+            ]
+            for name, records, index in tests:
+                start = time.time()
+                records()
+                cost_records = time.time() - start
+                start = time.time()
+                index()
+                cost_index = time.time() - start
+                print('project  size=%-6d %-5s records %7.1f ms  index %7.1f ms  %s' % (
+                    size, name, cost_records * 1000, cost_index * 1000, screen))
+    finally:
+        shutil.rmtree(path)
+
+
+ORDERS = [
+    ['-aror.1y'],
+    ['-days'],
+    ['kind', '-mdd.2020'],
+    ['-update_time'],
+]
+
+
+def bench_order(options):
+    '''取排序后的前 50 条: 读取全部记录后排序与 order_by()[:50] 的耗时'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        size = max(options['sizes'])
+        for i in range(size):
+            fund = make_fund(i, days=0)
+            fund['update_time'] = fund['days']
+            table.save(fund)
+        table.analyze()
+        for order in ORDERS:
+            start = time.time()
+            funds = table.filter(shallow=True).list()
+            for field in reversed(order):
+                name = field.lstrip('-')
+                funds.sort(key=lambda x: get_key(x, name) or 0, reverse=field.startswith('-'))
+            funds[:50]
+            cost_sort = time.time() - start
+            start = time.time()
+            table.filter(shallow=True).order_by(*order)[:50].list()
+            cost_order = time.time() - start
+            print('order  size=%-6d sort %7.1f ms  order_by %7.1f ms  %s' % (
+                size, cost_sort * 1000, cost_order * 1000, ','.join(order)))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_ensure(options):
+    '''ensure_index() 重建索引的耗时与内存峰值'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        for size in options['sizes']:
+            for i in range(len(table.list_pk()), size):
+                table.save(make_fund(i, days=options['days']))
+            tracemalloc.start()
+            start = time.time()
+            table.ensure_index()
+            cost = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('ensure  size=%-6d %8.1f ms  peak %8d bytes' % (size, cost * 1000, peak))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_bulk(options):
+    '''写入 size 条记录: 逐条 save(), 逐条写入后重建索引 (原 bulk_save) 与 bulk_writer() 的耗时'''
+    size = max(options['sizes'])
+    funds = [make_fund(i, days=options['days']) for i in range(size)]
+
+    def save(table):
+        for fund in funds:
+            table.save(dict(fund))
+
+    def save_ensure(table):
+        for fund in funds:
+            table.save(dict(fund), do_not_update_cache=True)
+        table.ensure_index()
+
+    def bulk_writer(table):
+        with table.bulk_writer() as writer:
+            for fund in funds:
+                writer.save(dict(fund))
+
+    for name, func in [('save', save), ('save+ensure', save_ensure), ('bulk_writer', bulk_writer)]:
+        path = tempfile.mkdtemp()
+        try:
+            table = make_table(path)
+            start = time.time()
+            func(table)
+            cost = time.time() - start
+            assert table.filter().count() == size
+            print('bulk  size=%-6d %-12s %8.1f ms' % (size, name, cost * 1000))
+        finally:
+            shutil.rmtree(path)
+
+
+def bench_delete(options):
+    '''删除一半的记录: 逐条 delete() 与 delete_many() 的耗时'''
+    size = max(options['sizes'])
+    tests = [
+        ('delete', lambda table, pkvals: [table.delete(i) for i in pkvals]),
+        ('delete_many', lambda table, pkvals: table.delete_many(pkvals)),
+    ]
+    for name, func in tests:
+        path = tempfile.mkdtemp()
+        try:
+            table = make_table(path)
+            table.bulk_save((make_fund(i, days=options['days']) for i in range(size)))
+            pkvals = table.list_pk()[::2]
+            start = time.time()
+            func(table, pkvals)
+            cost = time.time() - start
+            assert table.filter().count() == size - len(pkvals)
+            print('delete  size=%-6d %-12s %8.1f ms' % (size, name, cost * 1000))
+        finally:
+            shutil.rmtree(path)
+
+
+def last_adjnav(fund):
+    return fund['code'], fund['adjnavs'][-1]['value']
+
+
+def bench_parallel(options):
+    '''读取完整记录: 单进程与 parallel() 的耗时, map 表示在子进程中只取最后一个净值'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        size = max(options['sizes'])
+        table.bulk_save((make_fund(i, days=options['days']) for i in range(size)))
+        qs = table.filter()
+        tests = [('serial', lambda: [last_adjnav(i) for i in qs])]
+        for workers in (2, 4):
+            tests.append(('workers=%d' % workers, lambda: [last_adjnav(i) for i in qs.parallel(workers=workers)]))
+            tests.append(('workers=%d map' % workers, lambda: list(qs.parallel(workers=workers, func=last_adjnav))))
+        for name, func in tests:
+            start = time.time()
+            func()
+            cost = time.time() - start
+            print('parallel  size=%-6d days=%-5d %-15s %8.1f ms' % (size, options['days'], name, cost * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_threads(options):
+    '''多线程读取: 不同线程数下 get_by_pk 的吞吐, 另有一个线程持续写入'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        size = max(options['sizes'])
+        table.bulk_save((make_fund(i, days=options['days']) for i in range(size)))
+        rnd = random.Random(0)
+        pkvals = ['%06d' % rnd.randrange(size) for _ in range(options['count'] * 8)]
+        for writing in (False, True):
+            stop = False
+
+            def writer():
+                i = 0
+                while not stop:
+                    table.save(make_fund(i % size, days=options['days'], seed=i))
+                    i += 1
+
+            for threads in (1, 2, 4, 8):
+                if writing:
+                    thread = threading.Thread(target=writer)
+                    thread.start()
+                chunks = [pkvals[i::threads] for i in range(threads)]
+                start = time.time()
+                with multiprocessing.dummy.Pool(threads) as pool:
+                    pool.map(lambda chunk: [table.get_by_pk(i) for i in chunk], chunks)
+                cost = time.time() - start
+                if writing:
+                    stop = True
+                    thread.join()
+                    stop = False
+                print('threads   size=%-6d threads=%-2d writer=%-5s %8.0f gets/s' % (
+                    size, threads, writing, len(pkvals) / cost))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_behind(options):
+    '''多个线程保存记录: 直接 save() 与 write_behind() 的耗时, 包括最后等待写入完成'''
+    for size in options['sizes']:
+        funds = [make_fund(i, days=options['days']) for i in range(size)]
+        tests = [
+            ('save', None),
+            ('behind durable', True),
+            ('behind', False),
+        ]
+        for name, durable in tests:
+            path = tempfile.mkdtemp()
+            try:
+                table = make_table(path)
+                start = time.time()
+                with multiprocessing.dummy.Pool(20) as pool:
+                    if durable is None:
+                        pool.map(table.save, funds)
+                    else:
+                        with table.write_behind(durable=durable) as writer:
+                            pool.map(writer.save, funds)
+                cost = time.time() - start
+                print('behind    size=%-6d %-15s %8.1f ms' % (size, name, cost * 1000))
+            finally:
+                shutil.rmtree(path)
+
+
+def bench_backends(options):
+    '''各存储后端的吞吐: 逐条 save(), 按主键批量读取完整记录, 以及 SCREENS 中的筛选'''
+    for size in options['sizes']:
+        funds = [make_fund(i, days=options['days']) for i in range(size)]
+        for backend in BACKENDS:
+            path = tempfile.mkdtemp()
+            try:
+                table = make_table(path, backend=backend)
+                start = time.time()
+                for fund in funds:
+                    table.save(fund)
+                cost_save = time.time() - start
+                pkvals = table.list_pk()
+                start = time.time()
+                table.bulk_get_by_pk(pkvals)
+                cost_get = time.time() - start
+                table.analyze()
+                start = time.time()
+                for screen in SCREENS:
+                    table._clear_cache()
+                    table.filter(parse_filter(screen), shallow=True).list()
+                cost_filter = time.time() - start
+                print('backends  size=%-6d %-7s save %7.0f/s  bulk_get %8.0f/s  filter %8.1f ms' % (
+                    size, backend, size / cost_save, size / cost_get, cost_filter * 1000))
+            finally:
+                shutil.rmtree(path)
+
+
+def bench_compress(options):
+    '''d1_ 和序列分块的压缩: 各算法节省的空间和每条的编解码耗时, 以及不同设置下 bulk_get 的耗时'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        size = max(options['sizes'])
+        table.bulk_save((make_fund(i, days=options['days']) for i in range(size)))
+        for row in table.compression_report():
+            print('compress  size=%-6d %s %-5s dict=%-5s saved %5.1f%%  compress %6.3f ms  decompress %6.3f ms' % (
+                size, row['data'], row['codec'], row['dictionary'], row['saved'] * 100, row['compress_ms'], row['decompress_ms']))
+        pkvals = table.list_pk()
+        for name, dictionary in (('none', False), ('zlib', False), ('zlib', True)):
+            table.compression = None if name == 'none' else name
+            table._dictionary_id = None
+            if dictionary:
+                table.train_dictionary()
+            before, after = table.recompress()
+            table._clear_cache()
+            start = time.time()
+            table.bulk_get_by_pk(pkvals)
+            cost = time.time() - start
+            print('compress  size=%-6d stored %-5s dict=%-5s %10d bytes  bulk_get %8.1f ms' % (
+                size, name, dictionary, after, cost * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+NGRAM_SCREENS = [
+    'name ~ "国开"',
+    'fullname ~ "易方达基金12"',
+    'managers ~ "张三"',
+    'name ~ "国开", days > 2000',
+]
+
+
+def bench_ngram(options):
+    '''~ 查询: 不使用 / 使用字词索引时的耗时 (每次清空缓存的索引列)'''
+    for size in options['sizes']:
+        for ngram_indexes in ((), NGRAM_INDEXES):
+            path = tempfile.mkdtemp()
+            try:
+                table = make_table(path, ngram_indexes=ngram_indexes)
+                table.bulk_save((make_fund(i, days=10) for i in range(size)))
+                table.analyze()
+                for screen in NGRAM_SCREENS:
+                    q = parse_filter(screen)
+                    start = time.time()
+                    for _ in range(10):
+                        table._clear_cache()
+                        count = table.filter(q, shallow=True).count()
+                    cost = (time.time() - start) / 10
+                    print('ngram     size=%-6d ngram=%-5s %8.1f ms  %5d  %s' % (
+                        size, bool(ngram_indexes), cost * 1000, count, screen))
+            finally:
+                shutil.rmtree(path)
+
+
+def bench_readahead(options):
+    '''遍历整个表 (完整记录): 不预读与后台预读的耗时'''
+    path = tempfile.mkdtemp()
+    depth = lib_dbs.READ_AHEAD_DEPTH
+    try:
+        table = make_table(path)
+        size = max(options['sizes'])
+        table.bulk_save((make_fund(i, days=options['days']) for i in range(size)))
+        for name, _depth in (('sync', 0), ('read-ahead', depth)):
+            lib_dbs.READ_AHEAD_DEPTH = _depth
+            start = time.time()
+            count = sum((1 for _ in table.filter(parse_filter('days > 0'))))
+            cost = time.time() - start
+            print('readahead size=%-6d days=%-5d %-10s %8.1f ms  %d' % (size, options['days'], name, cost * 1000, count))
+    finally:
+        lib_dbs.READ_AHEAD_DEPTH = depth
+        shutil.rmtree(path)
+
+
+def bench_querycache(options):
+    '''重复执行 SCREENS: 首次, 内存中缓存的结果, 以及新打开的表读取保存在数据库中的结果'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path, persist_queries=True)
+        size = max(options['sizes'])
+        table.bulk_save((make_fund(i, days=10) for i in range(size)))
+        table.analyze()
+        reopened = make_table(path, persist_queries=True)
+        for screen in SCREENS:
+            costs = []
+            for _table in (table, table, reopened):
+                start = time.time()
+                count = len(_table.filter(parse_filter(screen), shallow=True).list_field('code'))
+                costs.append(time.time() - start)
+            print('querycache size=%-6d cold %8.1f ms  memo %6.2f ms  persisted %6.2f ms  %5d  %s' % (
+                size, costs[0] * 1000, costs[1] * 1000, costs[2] * 1000, count, screen))
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_views(options):
+    '''每个 SCREEN 注册一个视图: 读取视图与 filter 的耗时, 以及 save 的额外开销'''
+    path = tempfile.mkdtemp()
+    try:
+        table = make_table(path)
+        size = max(options['sizes'])
+        table.bulk_save((make_fund(i, days=10) for i in range(size)))
+        table.analyze()
+        start = time.time()
+        for i in range(options['count']):
+            table.save(make_fund(i, days=10))
+        save_cost = (time.time() - start) / options['count']
+        for i, screen in enumerate(SCREENS):
+            table.create_view('screen%d' % i, parse_filter(screen), ['name', 'days'])
+        for i, screen in enumerate(SCREENS):
+            table.clear_query_cache()
+            start = time.time()
+            count = len(table.filter(parse_filter(screen), shallow=True).list_field('code'))
+            filter_cost = time.time() - start
+            table._clear_cache()
+            start = time.time()
+            assert len(table.get_view('screen%d' % i)) == count
+            view_cost = time.time() - start
+            print('views size=%-6d filter %8.1f ms  view %6.2f ms  %5d  %s' % (
+                size, filter_cost * 1000, view_cost * 1000, count, screen))
+        start = time.time()
+        for i in range(options['count']):
+            table.save(make_fund(i, days=10))
+        view_save_cost = (time.time() - start) / options['count']
+        print('views size=%-6d save %6.2f ms  save with %d views %6.2f ms' % (
+            size, save_cost * 1000, len(SCREENS), view_save_cost * 1000))
+    finally:
+        shutil.rmtree(path)
+
+
+BENCHES = {
+    'save': bench_save,
+    'filter': bench_filter,
+    'compile': bench_compile,
+    'columns': bench_columns,
+    'series': bench_series,
+    'chunks': bench_chunks,
+    'cache': bench_cache,
+    'project': bench_project,
+    'order': bench_order,
+    'ensure': bench_ensure,
+    'bulk': bench_bulk,
+    'delete': bench_delete,
+    'parallel': bench_parallel,
+    'threads': bench_threads,
+    'behind': bench_behind,
+    'backends': bench_backends,
+    'compress': bench_compress,
+    'ngram': bench_ngram,
+    'readahead': bench_readahead,
+    'querycache': bench_querycache,
+    'views': bench_views,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='lib_dbs 性能测试')
+    parser.add_argument('bench', choices=list(BENCHES), nargs='+')
+    parser.add_argument('--sizes', default='1000,2000,4000,8000', help='表的大小')
+    parser.add_argument('--count', type=int, default=200, help='每轮测试的次数')
+    parser.add_argument('--days', type=int, default=250, help='每只基金的净值天数')
+    args = parser.parse_args()
+    options = vars(args)
+    options['sizes'] = [int(i) for i in args.sizes.split(',')]
+    for bench in args.bench:
+        BENCHES[bench](options)
+
+
+if __name__ == '__main__':
+    main()
@@ -31,9 +31,10 @@ def update_chinabond_indexes():
             print(index['name'])
             Index.save(index)
     # 删除
-    for name in set(Index.filter(source='chinabond').list_field('name')) - set(names):
-        Index.delete(name)
+    stale = set(Index.filter(source='chinabond').list_field('name')) - set(names)
+    for name in stale:
         print(f'delete {name}')
+    Index.delete_many(stale)
 
 
 def main():
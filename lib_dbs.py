@@ -2,17 +2,44 @@
 # -*- coding: utf-8 -*-
 # Copyright (C) 2020 - , puxxustc
 
-from typing import List, Dict
+from collections import OrderedDict, deque
+from typing import List, Dict, Iterator, Tuple
+import atexit
+import bisect
+import concurrent.futures
+import contextlib
 import datetime
 import functools
+import hashlib
+import heapq
 import itertools
+import operator
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
 
 import more_itertools
 import msgpack
 import lsm
+import numpy as np
+
+# 可选的压缩算法
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 from lib_filter import Q
+from lib_util import day2msts
 
 
 # patch msgpack.Unpacker
@@ -20,71 +47,691 @@ msgpack._Unpacker = msgpack.Unpacker
 msgpack.Unpacker = functools.partial(msgpack._Unpacker, max_buffer_size=512 * 1024 * 1204)
 
 
-class LSM_DB_Wrapper():
-    def __init__(self, db_uri: str):
-        self.db = lsm.LSM(db_uri)
+class DB_Wrapper():
+    '''
+    存储后端的接口, key 和 value 均为 bytes, key 按字节序排列
+
+    子类需要实现 get, put, delete, multi_get, multi_put, iter_range, delete_prefix,
+    begin, commit, rollback; 事务可以嵌套, 事务进行中其他线程不能写入
+    '''
+    # 持有事务的线程
+    _owner = None
+
+    def get(self, key: bytes):
+        raise NotImplementedError
+
+    def put(self, key: bytes, value: bytes):
+        raise NotImplementedError
+
+    def delete(self, key: bytes):
+        raise NotImplementedError
+
+    def multi_get(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        raise NotImplementedError
+
+    def multi_put(self, data: Dict[bytes, bytes]):
+        raise NotImplementedError
+
+    def iter_range(self, start: bytes, end: bytes = None, prefix: bytes = None, values: bool = False,
+                   page_size: int = 200) -> Iterator:
+        '''
+        从 start 开始按顺序遍历, 超过 end (包含在内) 或不再以 prefix 开头时停止,
+        values 为 True 时返回 (key, value), 否则只返回 key; 遍历过程中可以写入数据库
+        '''
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix: bytes):
+        raise NotImplementedError
+
+    def begin(self):
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        raise NotImplementedError
+
+    def in_transaction(self) -> bool:
+        '''当前线程是否持有事务'''
+        return self._owner == threading.get_ident()
+
+    def scan_keys(self, prefix: bytes = None) -> List[bytes]:
+        return list(self.iter_prefix(prefix or b''))
+
+    def iter_prefix(self, prefix: bytes, values: bool = False) -> Iterator:
+        return self.iter_range(prefix, prefix=prefix, values=values)
+
+    def scan(self, prefix: bytes) -> List[Tuple[bytes, bytes]]:
+        return list(self.iter_prefix(prefix, values=True))
+
+    def scan_range(self, start: bytes, end: bytes) -> List[Tuple[bytes, bytes]]:
+        # start, end 均包含在内
+        if start > end:
+            return []
+        return list(self.iter_range(start, end, values=True))
+
+    def checkpoint(self):
+        pass
+
+    def set_autocheckpoint(self, size: int) -> int:
+        return 0
+
+
+def _prefix_end(prefix: bytes):
+    '''大于所有以 prefix 开头的 key 的最小值, 不存在时返回 None'''
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+class LSM_DB_Wrapper(DB_Wrapper):
+    '''
+    多线程读写: 每个线程 (及 fork 出的进程) 使用各自的只读连接读取,
+    写入使用同一个写连接, 由锁串行化; 事务进行中, 持有事务的线程通过写连接读取未提交的数据
+    '''
+    def __init__(self, db_uri: str, readonly: bool = False):
+        self.db_uri = db_uri
+        self.readonly = readonly
+        self.db = lsm.LSM(db_uri, readonly=readonly)
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._owner = None
+        self._depth = 0
+
+    def _reader(self):
+        if self._owner == threading.get_ident():
+            return self._writer()
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.db = lsm.LSM(self.db_uri, readonly=True)
+            local.pid = os.getpid()
+        return local.db
+
+    def _writer(self):
+        # fork 出的进程不能使用父进程的连接
+        if self._pid != os.getpid():
+            self.db = lsm.LSM(self.db_uri, readonly=self.readonly)
+            self._pid = os.getpid()
+        return self.db
 
     def get(self, key: bytes):
         try:
-            return self.db.fetch(key)
+            return self._reader().fetch(key)
         except KeyError:
             return None
 
     def put(self, key: bytes, value: bytes):
-        self.db.insert(key, value)
+        with self._lock:
+            self._writer().insert(key, value)
 
     def delete(self, key: bytes):
-        self.db.delete(key)
+        with self._lock:
+            self._writer().delete(key)
 
     def multi_get(self, keys: List[bytes]) -> Dict[bytes, bytes]:
-        return self.db.fetch_bulk(keys)
+        return self._reader().fetch_bulk(keys)
 
     def multi_put(self, data: Dict[bytes, bytes]):
-        self.db.update(data)
+        with self._lock:
+            self._writer().update(data)
 
     def scan_keys(self, prefix: bytes = None) -> List[bytes]:
         if not prefix:
-            return list(self.db.keys())
+            return list(self._reader().keys())
+        return list(self.iter_prefix(prefix))
+
+    def iter_range(self, start: bytes, end: bytes = None, prefix: bytes = None, values: bool = False,
+                   page_size: int = 200) -> Iterator:
+        '''每次读取 page_size 条后关闭 cursor 再返回, 遍历过程中可以写入数据库'''
+        last = None
+        while True:
+            page = []
+            done = False
+            with self._reader().cursor() as cursor:
+                try:
+                    cursor.seek(start, lsm.SEEK_GE)
+                except KeyError:
+                    return
+                while len(page) < page_size:
+                    key = cursor.key()
+                    if (end is not None and key > end) or (prefix is not None and not key.startswith(prefix)):
+                        done = True
+                        break
+                    # 从上一页的最后一个 key 开始 seek, 跳过它
+                    if key != last:
+                        page.append((key, cursor.value()) if values else key)
+                    try:
+                        cursor.next()
+                    except StopIteration:
+                        done = True
+                        break
+            yield from page
+            if done or not page:
+                return
+            start = last = page[-1][0] if values else page[-1]
+
+    def scan(self, prefix: bytes) -> List[Tuple[bytes, bytes]]:
+        return list(self._reader()[prefix:prefix + b'\xff'])
+
+    def scan_range(self, start: bytes, end: bytes) -> List[Tuple[bytes, bytes]]:
+        # start, end 均包含在内
+        if start > end:
+            return []
+        return list(self._reader()[start:end])
+
+    def delete_prefix(self, prefix: bytes):
+        with self._lock:
+            self._writer().delete_range(prefix, prefix + b'\xff')
+
+    def begin(self):
+        # 事务结束前其他线程不能写入
+        self._lock.acquire()
+        try:
+            self._writer().begin()
+        except BaseException:
+            self._lock.release()
+            raise
+        self._owner = threading.get_ident()
+        self._depth += 1
+
+    def commit(self):
+        try:
+            self._writer().commit()
+        finally:
+            self._end()
+
+    def rollback(self):
+        try:
+            db = self._writer()
+            if self._depth > 1:
+                # rollback(keep_transaction=False) 会回滚所有层的事务, 只回滚最内层后提交空的事务
+                db.rollback(keep_transaction=True)
+                db.commit()
+            else:
+                db.rollback(keep_transaction=False)
+        finally:
+            self._end()
+
+    def _end(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+        self._lock.release()
+
+    def checkpoint(self):
+        with self._lock:
+            self._writer().checkpoint(0)
+
+    def set_autocheckpoint(self, size: int) -> int:
+        # 返回原来的设置, size 为 0 时不自动 checkpoint
+        with self._lock:
+            db = self._writer()
+            old = db.autocheckpoint
+            db.autocheckpoint = size
+            return old
+
+
+class _MemoryStore():
+    def __init__(self):
+        self.data = {}
+        # 排好序的 key
+        self.keys = []
+        self.lock = threading.RLock()
+        self.owner = None
+        # 每层事务一个 {key: 原来的值}, 原来不存在时为 None
+        self.undo = []
+
+
+# 同一进程中, 相同 db_uri 的内存数据库共享数据, fork 出的子进程得到一份拷贝
+_memory_stores = {}
+
+
+class Memory_DB_Wrapper(DB_Wrapper):
+    '''
+    内存中的数据库, 用于测试和性能对比, 进程退出后数据丢失
+
+    读写都持有同一个锁, 事务进行中其他线程的读写等待事务结束
+    '''
+    def __init__(self, db_uri: str, readonly: bool = False):
+        self.db_uri = db_uri
+        self.readonly = readonly
+        self.store = _memory_stores.setdefault(db_uri, _MemoryStore())
+
+    def _set(self, key, value):
+        store = self.store
+        if store.undo and key not in store.undo[-1]:
+            store.undo[-1][key] = store.data.get(key)
+        self._write(key, value)
+
+    def _write(self, key, value):
+        # 直接修改数据, 不记录到回滚日志
+        store = self.store
+        old = store.data.get(key)
+        if value is None:
+            if old is not None:
+                del store.data[key]
+                del store.keys[bisect.bisect_left(store.keys, key)]
+        else:
+            if old is None:
+                bisect.insort(store.keys, key)
+            store.data[key] = value
 
-        with self.db.cursor() as cursor:
+    def get(self, key: bytes):
+        with self.store.lock:
+            return self.store.data.get(key)
+
+    def put(self, key: bytes, value: bytes):
+        with self.store.lock:
+            self._set(key, value)
+
+    def delete(self, key: bytes):
+        with self.store.lock:
+            self._set(key, None)
+
+    def multi_get(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        with self.store.lock:
+            data = self.store.data
+            return {key: data[key] for key in keys if key in data}
+
+    def multi_put(self, data: Dict[bytes, bytes]):
+        with self.store.lock:
+            for key, value in data.items():
+                self._set(key, value)
+
+    def iter_range(self, start: bytes, end: bytes = None, prefix: bytes = None, values: bool = False,
+                   page_size: int = 200) -> Iterator:
+        store = self.store
+        while True:
+            with store.lock:
+                i = bisect.bisect_left(store.keys, start)
+                keys = store.keys[i:i + page_size]
+                done = len(keys) < page_size
+                page = []
+                for key in keys:
+                    if (end is not None and key > end) or (prefix is not None and not key.startswith(prefix)):
+                        done = True
+                        break
+                    page.append((key, store.data[key]) if values else key)
+            yield from page
+            if done or not page:
+                return
+            start = (page[-1][0] if values else page[-1]) + b'\x00'
+
+    def delete_prefix(self, prefix: bytes):
+        with self.store.lock:
+            store = self.store
+            i = bisect.bisect_left(store.keys, prefix)
+            j = i
+            while j < len(store.keys) and store.keys[j].startswith(prefix):
+                j += 1
+            for key in store.keys[i:j]:
+                self._set(key, None)
+
+    def begin(self):
+        self.store.lock.acquire()
+        self.store.undo.append({})
+        self.store.owner = threading.get_ident()
+
+    def commit(self):
+        store = self.store
+        try:
+            undo = store.undo.pop()
+            if store.undo:
+                # 嵌套的事务提交后, 由外层事务负责回滚
+                for key, value in undo.items():
+                    store.undo[-1].setdefault(key, value)
+        finally:
+            self._end()
+
+    def rollback(self):
+        store = self.store
+        try:
+            undo = store.undo.pop()
+            # 恢复的值就是外层事务中的值, 不能再记录到外层事务的回滚日志
+            for key, value in undo.items():
+                self._write(key, value)
+        finally:
+            self._end()
+
+    def _end(self):
+        store = self.store
+        if not store.undo:
+            store.owner = None
+        store.lock.release()
+
+    def in_transaction(self) -> bool:
+        return self.store.owner == threading.get_ident()
+
+
+class SQLite_DB_Wrapper(DB_Wrapper):
+    '''
+    SQLite 数据库, 所有数据在一个 (key, value) 表中, 使用 WAL 模式
+
+    与 LSM_DB_Wrapper 相同, 每个线程使用各自的只读连接读取, 写入使用同一个写连接, 由锁串行化,
+    持有事务的线程通过写连接读取; 嵌套的事务使用 SAVEPOINT
+    '''
+    def __init__(self, db_uri: str, readonly: bool = False):
+        self.db_uri = db_uri
+        self.readonly = readonly
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._owner = None
+        self._depth = 0
+        self._pid = None
+        self._writer()
+
+    def _connect(self, readonly):
+        if readonly:
+            conn = sqlite3.connect('file:%s?mode=ro' % self.db_uri, uri=True, isolation_level=None,
+                                   check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.db_uri, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key BLOB PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID')
+        return conn
+
+    def _reader(self):
+        if self._owner == threading.get_ident():
+            return self._writer()
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.db = self._connect(True)
+            local.pid = os.getpid()
+        return local.db
+
+    def _writer(self):
+        # fork 出的进程不能使用父进程的连接
+        if self._pid != os.getpid():
+            self.db = self._connect(self.readonly)
+            self._pid = os.getpid()
+        return self.db
+
+    def _write(self, sql, params=(), many=False):
+        with self._lock:
+            db = self._writer()
+            if self._depth:
+                return db.executemany(sql, params) if many else db.execute(sql, params)
+            # 不在事务中时, 每次写入作为一个事务
+            db.execute('BEGIN')
             try:
-                cursor.seek(prefix, lsm.SEEK_GE)
-            except KeyError:
-                return []
-            keys = []
-            while True:
-                keys.append(cursor.key())
-                try:
-                    cursor.next()
-                except StopIteration:
-                    break
-            return keys
+                db.executemany(sql, params) if many else db.execute(sql, params)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+
+    def get(self, key: bytes):
+        row = self._reader().execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key: bytes, value: bytes):
+        self._write('INSERT OR REPLACE INTO kv VALUES (?, ?)', (key, value))
+
+    def delete(self, key: bytes):
+        self._write('DELETE FROM kv WHERE key = ?', (key,))
+
+    def multi_get(self, keys: List[bytes]) -> Dict[bytes, bytes]:
+        db = self._reader()
+        result = {}
+        # SQLite 限制每条语句的参数个数
+        for _keys in more_itertools.chunked(keys, 500):
+            sql = 'SELECT key, value FROM kv WHERE key IN (%s)' % ','.join('?' * len(_keys))
+            result.update(db.execute(sql, _keys))
+        return result
+
+    def multi_put(self, data: Dict[bytes, bytes]):
+        self._write('INSERT OR REPLACE INTO kv VALUES (?, ?)', data.items(), many=True)
+
+    def iter_range(self, start: bytes, end: bytes = None, prefix: bytes = None, values: bool = False,
+                   page_size: int = 200) -> Iterator:
+        conditions = ['key >= ?']
+        params = [start]
+        if end is not None:
+            conditions.append('key <= ?')
+            params.append(end)
+        if prefix is not None and _prefix_end(prefix) is not None:
+            conditions.append('key < ?')
+            params.append(_prefix_end(prefix))
+        sql = 'SELECT key, value FROM kv WHERE %s ORDER BY key LIMIT ?' if values else \
+            'SELECT key FROM kv WHERE %s ORDER BY key LIMIT ?'
+        sql = sql % ' AND '.join(conditions)
+        while True:
+            rows = self._reader().execute(sql, params + [page_size]).fetchall()
+            if values:
+                yield from rows
+            else:
+                yield from (row[0] for row in rows)
+            if len(rows) < page_size:
+                return
+            # 下一页从上一页的最后一个 key 之后开始
+            sql = sql.replace('key >= ?', 'key > ?', 1)
+            params[0] = rows[-1][0]
+
+    def delete_prefix(self, prefix: bytes):
+        end = _prefix_end(prefix)
+        if end is None:
+            self._write('DELETE FROM kv WHERE key >= ?', (prefix,))
+        else:
+            self._write('DELETE FROM kv WHERE key >= ? AND key < ?', (prefix, end))
+
+    def begin(self):
+        # 事务结束前其他线程不能写入
+        self._lock.acquire()
+        try:
+            db = self._writer()
+            db.execute('SAVEPOINT sp%d' % self._depth if self._depth else 'BEGIN')
+        except BaseException:
+            self._lock.release()
+            raise
+        self._owner = threading.get_ident()
+        self._depth += 1
+
+    def commit(self):
+        try:
+            depth = self._depth - 1
+            self._writer().execute('RELEASE sp%d' % depth if depth else 'COMMIT')
+        finally:
+            self._end()
+
+    def rollback(self):
+        try:
+            depth = self._depth - 1
+            if depth:
+                self._writer().execute('ROLLBACK TO sp%d' % depth)
+                self._writer().execute('RELEASE sp%d' % depth)
+            else:
+                self._writer().execute('ROLLBACK')
+        finally:
+            self._end()
+
+    def _end(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self._owner = None
+        self._lock.release()
+
+    def checkpoint(self):
+        with self._lock:
+            self._writer().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def set_autocheckpoint(self, size: int) -> int:
+        # 返回原来的设置 (页数), size 为 0 时不自动 checkpoint
+        with self._lock:
+            db = self._writer()
+            old = db.execute('PRAGMA wal_autocheckpoint').fetchone()[0]
+            db.execute('PRAGMA wal_autocheckpoint=%d' % size)
+            return old
+
+
+# Table 的 backend 参数
+BACKENDS = {
+    'lsm': LSM_DB_Wrapper,
+    'memory': Memory_DB_Wrapper,
+    'sqlite': SQLite_DB_Wrapper,
+}
 
 
 '''
 数据库格式
 
 
-索引  i_{pk}
+索引  i_{field}\x00{pk}     每个 (字段, 主键) 一条记录, 值为字段值
+有序索引  x_{field}\x00{sortable value}\x00{pk}     值为空, 用于范围查询
+字词索引  g_{field}\x00{gram}\x00{pk}     值为空, ngram_indexes 中字段 (小写) 的单字和二元组, 用于 ~ 查询
+版本  m_index_version
+索引字段  m_index_fields     已建立索引的字段, 打开表时为新增的字段建立索引, 删除去掉的字段的索引
+写入标记  m_generation     每次写入时更新为随机值, 用于发现其他进程的写入
+统计  m_stats     各索引字段的取值分布, 用于估算查询计划的代价
 
 数据  d0_{pk}
-数据  d1_{pk}
+数据  d1_{pk}     heavy_keys 中除序列以外的字段, 可以压缩, 第一个字节为压缩方式
+序列  d2_{pk}\x00{field}     series_keys 中的序列按年 (UTC) 分块, 值为年份列表, 分块压缩时为 {'years': 年份列表, 'compressed': True}
+序列  d2_{pk}\x00{field}\x00{year}     SERIES_DTYPE 数组, 分块压缩时与 d1_ 相同, 未压缩的分块第一个字节为 0xff
+
+查询结果  q_{sha1}     [m_generation, 主键列表], persist_queries 为 True 时保存, m_generation 不同时失效
+视图  v_{name}     {pk: [字段值, ...]}, 满足视图条件的记录及其字段, save, delete 时更新
+视图定义  m_view\x00{name}     [Q 的规范化字符串, 字段列表], 定义改变时重建视图
+压缩字典  m_dict     当前使用的字典 id
+压缩字典  m_dict\x00{id}     字典内容
+
+旧格式  i_{field}         整个表的索引存放在一条记录中, 打开表时自动转换
 
 '''
 
 
+INDEX_VERSION_KEY = b'm_index_version'
+INDEX_VERSION = b'4'
+INDEX_FIELDS_KEY = b'm_index_fields'
+
+# 有序索引中值的类型标记, 同类型的值按编码后的字节序排列
+_SORT_NULL = b'\x01'
+_SORT_NUMBER = b'\x02'
+_SORT_STRING = b'\x03'
+_SORT_OTHER = b'\x04'
+
+RANGE_OPS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '===': operator.eq,
+    '$in': operator.eq,
+}
+
+# 净值序列 [[ts, value, change], ...] 以结构化数组保存, 读取时直接使用 np.frombuffer
+SERIES_DTYPE = np.dtype([
+    ('ts', '<i8'),
+    ('value', '<f8'),
+    ('change', '<f8'),
+])
+EXT_SERIES = 1
+# datetime 以 msgpack Timestamp 的格式保存, 读取时为本地时间的 naive datetime
+EXT_DATETIME = 2
+
+GENERATION_KEY = b'm_generation'
+
+STATS_KEY = b'm_stats'
+STATS_BUCKETS = 32
+
+# _filter 预读: 初始分片的主键数, 之后按记录大小调整, 使每个分片约为 READ_AHEAD_BYTES;
+# 最多预读 READ_AHEAD_DEPTH 个分片, 为 0 时不预读
+READ_AHEAD_DEPTH = 2
+READ_AHEAD_SLICE = 200
+READ_AHEAD_MIN_SLICE = 50
+READ_AHEAD_MAX_SLICE = 2000
+READ_AHEAD_BYTES = 4 * 1024 * 1024
+READ_AHEAD_WORKERS = 4
+
+# 每个 generation 在内存中缓存的查询结果数
+QUERY_CACHE_SIZE = 128
+
+# d1_ 的压缩方式, 压缩后的数据第一个字节为 id, 使用字典时再加上 _CODEC_DICT, 之后 4 字节为字典 id;
+# 未压缩的数据是 msgpack map, 第一个字节 >= 0x80, 两者可以共存
+# 序列分块不使用字典, 没有变小时在原始数据前加上 _CHUNK_RAW
+CODECS = {
+    'zlib': 1,
+    'lz4': 2,
+    'zstd': 3,
+}
+_CODEC_NAMES = {v: k for k, v in CODECS.items()}
+_CHUNK_RAW = b'\xff'
+_CODEC_DICT = 0x40
+DICT_KEY = b'm_dict'
+
+# 无法通过统计估算时, 各运算符的默认选择率
+DEFAULT_SELECTIVITY = {
+    '~': 0.1,
+    '!~': 0.9,
+    '!=': 0.9,
+}
+
+
 class Table:
-    def __init__(self, db_uri, name, pk, indexes, heavy_keys):
+    def __init__(self, db_uri, name, pk, indexes, heavy_keys, series_keys=(),
+                 cache_items=0, cache_bytes=256 * 1024 * 1024, readonly=False, backend='lsm',
+                 compression=None, compression_level=None, ngram_indexes=(), persist_queries=False,
+                 views=None):
         self.db_uri = db_uri
-        self._db = LSM_DB_Wrapper(db_uri)
         self.name = name
+        # compression 为 CODECS 中的名字时压缩写入的 d1_ 和序列分块, 读取时按第一个字节解压, 与设置无关
+        if compression is not None and not _codec_available(compression):
+            raise ValueError(self.__str__() + '.__init__(): compression %s not available' % compression)
+        self.compression = compression
+        self.compression_level = compression_level
+        # backend 为 BACKENDS 中的名字, 或 DB_Wrapper 的子类
+        if isinstance(backend, str):
+            if backend not in BACKENDS:
+                raise ValueError(self.__str__() + '.__init__(): unknown backend %s' % backend)
+            backend = BACKENDS[backend]
+        self.backend = backend
+        self._db = backend(db_uri, readonly=readonly)
         self.pk = pk
         self.indexes = indexes
         self.index_keys = {
-            k: b'i_%s' % k.encode('utf-8')
+            k: b'i_%s\x00' % k.encode('utf-8')
             for k in itertools.chain([pk], indexes)
         }
+        self.range_keys = {
+            k: b'x_%s\x00' % k.encode('utf-8')
+            for k in itertools.chain([pk], indexes)
+        }
+        # 字词索引的字段必须是顶层的索引字段
+        for k in ngram_indexes:
+            if k not in indexes or '.' in k:
+                raise ValueError(self.__str__() + '.__init__(): ngram index %s not in indexes' % k)
+        self.ngram_keys = {
+            k: b'g_%s\x00' % k.encode('utf-8')
+            for k in ngram_indexes
+        }
         self.heavy_keys = heavy_keys
+        self.series_keys = series_keys
+        # 解码后记录的缓存, cache_items 为 0 时不缓存; 启用缓存时返回的记录中嵌套的值与缓存共用, 不能修改
+        self.cache = RecordCache(cache_items, cache_bytes) if cache_items else None
+        self._stats = None
+        self._stats_changes = 0
+        # 按 generation 缓存的主键列表, 索引和索引列, 每次写入后清空
+        self.generation = 0
+        self._db_generation = None
+        self._memo = {}
+        # 压缩字典 {id: bytes}, 写入时使用 m_dict 中的字典
+        self._dictionaries = {}
+        self._dictionary_id = self._db.get(DICT_KEY)
+        # 查询结果除了缓存在内存中, 是否同时保存在数据库中, 供之后打开的表使用
+        self.persist_queries = persist_queries
+        if not readonly:
+            self.migrate_index()
+        else:
+            self._check_index_version()
+            self._drop_unbuilt_indexes()
+        # 视图 {name: View}, views 为 {name: (q, fields)}
+        self.views = {}
+        for name, (q, fields) in (views or {}).items():
+            self.create_view(name, q, fields)
 
     def __str__(self):
         return '<Table #%s>' % self.name
@@ -98,36 +745,496 @@ class Table:
             yield val
 
     def list_pk(self):
+        memo = self._get_memo()
+        if 'pk' not in memo:
+            db = self._db
+            prefix = self.index_keys[self.pk]
+            memo['pk'] = [key[len(prefix):].decode('utf8') for key, _ in db.scan(prefix)]
+        return list(memo['pk'])
+
+    def load_index(self, key):
+        '''返回 {pk: value}, 结果会被缓存, 调用者不应修改'''
+        memo = self._get_memo()
+        if ('index', key) not in memo:
+            db = self._db
+            prefix = self.index_keys[key]
+            memo[('index', key)] = {
+                db_key[len(prefix):].decode('utf8'): _unpackb(value)
+                for db_key, value in db.scan(prefix)
+            }
+        return memo[('index', key)]
+
+    def load_index_rows(self, keys, pkvals=None):
+        # 读取索引字段, 返回 {pk: {field: value}}
         db = self._db
-        key = self.index_keys[self.pk]
-        data = msgpack.unpackb(db.get(key))
-        return list(data.keys())
+        rows = {}
+        if pkvals is None:
+            for key in keys:
+                for pkval, val in self.load_index(key).items():
+                    rows.setdefault(pkval, {})
+                    put_key(rows[pkval], key, val)
+        else:
+            db_keys = {
+                (key, pkval): self.get_index_key(key, pkval)
+                for key in keys
+                for pkval in pkvals
+            }
+            db_data = db.multi_get(list(db_keys.values()))
+            for (key, pkval), db_key in db_keys.items():
+                if db_key in db_data:
+                    rows.setdefault(pkval, {})
+                    put_key(rows[pkval], key, _unpackb(db_data[db_key]))
+        return rows
+
+    def index_field(self, key):
+        # Q 中的字段对应的索引字段, 'a.b.c' 使用 'a.b.c', 'a.b', 'a' 中最长的已索引的路径
+        while key not in self.index_keys:
+            if '.' not in key:
+                return None
+            key = key.rpartition('.')[0]
+        return key
+
+    def _seek_bounds(self, key, op, value):
+        if key not in self.range_keys or op not in RANGE_OPS:
+            return None
+        if op == '$in':
+            if not isinstance(value, (list, tuple, set)):
+                return None
+            values = value
+        else:
+            values = [value]
+        prefix = self.range_keys[key]
+        bounds = []
+        for value in values:
+            sortable = _encode_sortable(value)
+            tag = sortable[:1]
+            if tag not in (_SORT_NUMBER, _SORT_STRING):
+                return None
+            if op in ('<', '<='):
+                bounds.append((value, prefix + tag, prefix + sortable + b'\x00\xff'))
+            elif op in ('>', '>='):
+                bounds.append((value, prefix + sortable, prefix + bytes([tag[0] + 1])))
+            else:
+                bounds.append((value, prefix + sortable + b'\x00', prefix + sortable + b'\x00\xff'))
+        return bounds
+
+    def seek_index(self, key, op, value):
+        '''
+        通过有序索引查找满足 Q(op, key, value) 的主键, 返回 (sure, maybe)
+
+        sure 中的记录一定满足条件, maybe 之外的记录一定不满足条件;
+        无法排序的值 (list, dict 等) 只出现在 maybe 中, 需要逐条匹配.
+        无法通过有序索引回答时返回 None
+        '''
+        bounds = self._seek_bounds(key, op, value)
+        if bounds is None:
+            return None
+        db = self._db
+        prefix = self.range_keys[key]
+        func = RANGE_OPS[op]
+        sure = set()
+        for value, start, end in bounds:
+            for db_key, _ in db.scan_range(start, end):
+                sortable, _, pkval = db_key[len(prefix):].rpartition(b'\x00')
+                if func(_decode_sortable(sortable), value):
+                    sure.add(pkval.decode('utf8'))
+        # 缺失值: 除 === 以外的运算符都视为匹配
+        if op != '===':
+            for db_key, _ in db.scan(prefix + _SORT_NULL):
+                sure.add(db_key.rpartition(b'\x00')[2].decode('utf8'))
+        maybe = set(sure)
+        for db_key, _ in db.scan(prefix + _SORT_OTHER):
+            maybe.add(db_key.rpartition(b'\x00')[2].decode('utf8'))
+        return sure, maybe
+
+    def seek_grams(self, key, value):
+        '''
+        通过字词索引查找满足 Q(~, key, value) 的主键, 返回 (sure, maybe)
+
+        包含 value 的所有单字 (value 只有一个字时) 或二元组的记录是候选, 需要逐条匹配;
+        缺失值视为匹配, 在 sure 中
+        '''
+        db = self._db
+        prefix = self.ngram_keys[key]
+        value = value.lower()
+        grams = {value} if len(value) == 1 else _ngrams(value) - set(value)
+        maybe = None
+        # 依次读取各个字词的主键, 结果为空时提前结束
+        for gram in grams:
+            _prefix = prefix + gram.encode('utf8') + b'\x00'
+            pkvals = {db_key[len(_prefix):].decode('utf8') for db_key in db.scan_keys(_prefix)}
+            maybe = pkvals if maybe is None else maybe & pkvals
+            if not maybe:
+                break
+        sure = set()
+        for db_key, _ in db.scan(self.range_keys[key] + _SORT_NULL):
+            sure.add(db_key.rpartition(b'\x00')[2].decode('utf8'))
+        return sure, maybe | sure
+
+    def analyze(self, persist=True):
+        '''
+        统计各索引字段的取值分布, 用于估算查询计划的代价
+
+        persist 为 False 或只读打开时只保存在内存中, 查询时自动统计不写入数据库
+        '''
+        db = self._db
+        fields = {}
+        for key, prefix in self.range_keys.items():
+            counts = {_SORT_NULL: 0, _SORT_OTHER: 0}
+            values = {_SORT_NUMBER: [], _SORT_STRING: []}
+            distinct = {_SORT_NUMBER: 0, _SORT_STRING: 0}
+            last = None
+            for db_key, _ in db.scan(prefix):
+                sortable = db_key[len(prefix):].rpartition(b'\x00')[0]
+                tag = sortable[:1]
+                if tag in values:
+                    if sortable != last:
+                        distinct[tag] += 1
+                        last = sortable
+                    values[tag].append(_decode_sortable(sortable))
+                else:
+                    counts[tag] += 1
+            fields[key] = {
+                'null': counts[_SORT_NULL],
+                'other': counts[_SORT_OTHER],
+                'number': _histogram(values[_SORT_NUMBER], distinct[_SORT_NUMBER]),
+                'string': _histogram(values[_SORT_STRING], distinct[_SORT_STRING]),
+            }
+        field = fields[self.pk]
+        rows = field['null'] + field['other'] + field['number']['n'] + field['string']['n']
+        stats = {'rows': rows, 'fields': fields}
+        if persist and not db.readonly:
+            db.put(STATS_KEY, msgpack.packb(stats))
+        self._stats = stats
+        self._stats_changes = 0
+        return stats
+
+    def get_stats(self):
+        # 其他进程写入过时重新读取统计信息
+        self._get_memo()
+        if self._stats is None:
+            data = self._db.get(STATS_KEY)
+            if data:
+                stats = msgpack.unpackb(data)
+                # 保存的统计信息之后其他进程写入的记录没有计入 _stats_changes, 按记录数的差计算
+                rows = len(self.get_column_pks())
+                self._stats_changes = max(self._stats_changes, abs(rows - stats['rows']))
+                self._stats = stats
+        if self._stats_stale():
+            self.analyze(persist=False)
+        return self._stats
+
+    def _stats_stale(self):
+        return self._stats is None or self._stats_changes > max(100, self._stats['rows'] * 0.2)
+
+    def estimate(self, key, op, value):
+        # 估算满足 Q(op, key, value) 的记录数
+        stats = self.get_stats()
+        rows = stats['rows']
+        field = stats['fields'].get(self.index_field(key))
+        if field is None:
+            return rows * DEFAULT_SELECTIVITY.get(op, 0.5)
+        if op in ('$e', '$true'):
+            return rows - field['null']
+        if op in ('$ne', '$false'):
+            return field['null']
+        if key not in stats['fields'] or self._seek_bounds(key, op, value) is None:
+            return rows * DEFAULT_SELECTIVITY.get(op, 0.5)
+        est = field['other']
+        if op != '===':
+            est += field['null']
+        for value in (value if op == '$in' else [value]):
+            part = field['string'] if isinstance(value, str) else field['number']
+            if not part['n']:
+                continue
+            if op in ('==', '===', '$in'):
+                est += part['n'] / part['distinct']
+                continue
+            if op in ('<', '>='):
+                frac = bisect.bisect_left(part['bounds'], value) / len(part['bounds'])
+            else:
+                frac = bisect.bisect_right(part['bounds'], value) / len(part['bounds'])
+            est += part['n'] * (frac if op in ('<', '<=') else 1 - frac)
+        return min(est, rows)
+
+    def plan(self, q, shallow=False):
+        '''为 Q 生成查询计划'''
+        rows = self.get_stats()['rows']
+        record_cost = COST_RECORD if shallow else COST_HEAVY_RECORD
+        return self._plan_and(q, _flatten_q(q, '&'), rows, record_cost)
+
+    def _plan(self, q, rows, record_cost):
+        if not q.complex:
+            return self._plan_leaf(q, rows)
+        op = q.complex[0]
+        if op == '~':
+            child = self._plan(q.complex[1], rows, record_cost)
+            if isinstance(child, RecordScanPlan):
+                return RecordScanPlan(self, q, rows, 0)
+            if isinstance(child, ColumnScanPlan):
+                cost = child.cost + rows * COST_COLUMN
+                return ColumnScanPlan(self, q, max(rows - child.rows, 0), cost)
+            cost = child.cost + rows * COST_INDEX_KEY
+            return NotPlan(self, q, max(rows - child.rows, 0), cost, [child])
+        elif op == '|':
+            children = [self._plan(i, rows, record_cost) for i in _flatten_q(q, '|')]
+            if any((isinstance(i, RecordScanPlan) for i in children)):
+                return RecordScanPlan(self, q, rows, 0)
+            miss = 1
+            for i in children:
+                miss *= 1 - (i.rows / rows if rows else 0)
+            est = rows * (1 - miss)
+            if all((isinstance(i, ColumnScanPlan) for i in children)):
+                return ColumnScanPlan(self, q, est, self._column_cost(q, rows))
+            cost = sum((i.cost for i in children))
+            return OrPlan(self, q, est, cost, children)
+        else:
+            return self._plan_and(q, _flatten_q(q, '&'), rows, record_cost)
+
+    def _plan_and(self, q, qs, rows, record_cost):
+        # 按选择率从高到低使用索引, 读取索引的代价高于少读取的记录时, 留给逐条匹配
+        children = sorted((self._plan(i, rows, record_cost) for i in qs), key=lambda x: x.rows)
+        chosen = []
+        residual = []
+        est = rows
+        for child in children:
+            selectivity = child.rows / rows if rows else 0
+            if not isinstance(child, RecordScanPlan) and est * (1 - selectivity) * record_cost > child.cost:
+                chosen.append(child)
+                est *= selectivity
+            else:
+                residual.append(child)
+        if not chosen:
+            return RecordScanPlan(self, q, rows, 0)
+        # 多个索引列合并为一次向量化计算
+        columns = [i for i in chosen if isinstance(i, ColumnScanPlan)]
+        if len(columns) > 1:
+            _q = functools.reduce(operator.and_, (i.q for i in columns))
+            _rows = rows
+            for i in columns:
+                _rows *= i.rows / rows
+            chosen = [i for i in chosen if i not in columns]
+            chosen.append(ColumnScanPlan(self, _q, _rows, self._column_cost(_q, rows)))
+        if len(chosen) == 1 and not residual:
+            return chosen[0]
+        cost = sum((i.cost for i in chosen))
+        return AndPlan(self, q, est, cost, chosen, residual)
+
+    def _plan_leaf(self, q, rows):
+        if q.op == '#EMPTY#':
+            return RecordScanPlan(self, q, rows, 0)
+        field = self.index_field(q.left)
+        if field is None:
+            return RecordScanPlan(self, q, rows, 0)
+        est = self.estimate(q.left, q.op, q.right)
+        cost = self._column_cost(q, rows)
+        if self._seek_bounds(q.left, q.op, q.right) is not None:
+            if est * COST_INDEX_KEY <= cost:
+                return SeekPlan(self, q, est, est * COST_INDEX_KEY)
+        if q.op == '~' and q.left in self.ngram_keys and isinstance(q.right, str) and q.right:
+            # 每个二元组读取一次主键列表
+            gram_cost = est * COST_INDEX_KEY * max(1, len(q.right) - 1)
+            if gram_cost <= cost:
+                return GramSeekPlan(self, q, est, gram_cost)
+        return ColumnScanPlan(self, q, est, cost)
+
+    def _column_cost(self, q, rows):
+        fields = {self.index_field(key) for key in q.keys()}
+        cost = len(q.keys()) * rows * COST_COLUMN
+        for field in fields:
+            if ('column', field) not in self._memo:
+                cost += rows * COST_INDEX_VALUE
+        return cost
+
+    def get_column_pks(self):
+        memo = self._get_memo()
+        if 'column_pks' not in memo:
+            memo['column_pks'] = np.array(self.list_pk(), dtype=object)
+        return memo['column_pks']
+
+    def get_column(self, field):
+        '''按主键顺序排列的索引字段'''
+        memo = self._get_memo()
+        if ('column', field) not in memo:
+            index = self.load_index(field)
+            values = [index.get(pkval) for pkval in self.get_column_pks()]
+            memo[('column', field)] = Column(field, values)
+        return memo[('column', field)]
+
+    def eval_columns(self, q):
+        '''在索引列上计算 Q, 返回按主键顺序排列的布尔数组, 结果与逐条 match() 相同'''
+        if q.op == '#EMPTY#':
+            return np.ones(len(self.get_column_pks()), dtype=bool)
+        if q.complex:
+            op = q.complex[0]
+            if op == '~':
+                return ~self.eval_columns(q.complex[1])
+            left = self.eval_columns(q.complex[1])
+            right = self.eval_columns(q.complex[2])
+            if op == '&':
+                return left & right
+            else:
+                return left | right
+        field = self.index_field(q.left)
+        column = self.get_column(field)
+        if q.left == field:
+            mask = column.mask(q.op, q.right)
+            if mask is not None:
+                return mask
+        # 无法向量化的运算 (如 list 的 ~), 逐条匹配
+        match = q.compile()
+        missing = match({})
+        mask = np.empty(len(column.values), dtype=bool)
+        for i, value in enumerate(column.values):
+            if value is None:
+                mask[i] = missing
+            else:
+                row = {}
+                put_key(row, field, value)
+                mask[i] = bool(match(row))
+        return mask
+
+    def cache_info(self):
+        if self.cache is None:
+            return None
+        return self.cache.info()
+
+    def _get_memo(self):
+        # m_generation 与本进程最后一次写入或读到的值不同, 说明其他进程写入过
+        db_generation = self._db.get(GENERATION_KEY)
+        if db_generation != self._db_generation:
+            self._db_generation = db_generation
+            self._clear_cache()
+            # 重新读取统计信息
+            self._stats = None
+            if self.cache is not None:
+                self.cache.clear()
+        return self._memo
+
+    def _touch(self):
+        '''写入完成后调用, 更新 generation 和 m_generation'''
+        self._db_generation = os.urandom(8)
+        self._db.put(GENERATION_KEY, self._db_generation)
+        self._clear_cache()
+
+    def _clear_cache(self):
+        self.generation += 1
+        self._memo = {}
+
+    def _complement(self, pkvals):
+        if pkvals is None:
+            return set()
+        return set(self.list_pk()) - pkvals
+
+    def migrate_index(self):
+        db = self._db
+        if db.get(INDEX_VERSION_KEY) != INDEX_VERSION:
+            # 旧格式: 整个表的索引存放在 i_{field} 中
+            for db_key in self.index_keys.values():
+                db.delete(db_key[:-1])
+            # 版本 2 及以前, 索引中的 datetime 保存为 {'__datetime__': ...}, 版本 3 及以前没有字词索引,
+            # 从数据重建索引
+            self.ensure_index()
+            return
+        data = db.get(INDEX_FIELDS_KEY)
+        if data is None:
+            # 没有记录索引字段时, 认为当前的索引字段都已建立索引
+            db.put(INDEX_FIELDS_KEY, msgpack.packb(self._index_fields()))
+            return
+        built = msgpack.unpackb(data)
+        if built == self._index_fields():
+            return
+        # 删除去掉的字段的索引, 只为新增的字段建立索引
+        for key in built['index']:
+            if key not in self.index_keys:
+                db.delete_prefix(b'i_%s\x00' % key.encode('utf-8'))
+                db.delete_prefix(b'x_%s\x00' % key.encode('utf-8'))
+        for key in built['ngram']:
+            if key not in self.ngram_keys:
+                db.delete_prefix(b'g_%s\x00' % key.encode('utf-8'))
+        fields = [key for key in self.index_keys if key not in built['index']]
+        ngram_fields = [key for key in self.ngram_keys if key not in built['ngram']]
+        self.build_index(fields, ngram_fields)
+
+    def _index_fields(self):
+        return {'index': list(self.index_keys), 'ngram': list(self.ngram_keys)}
+
+    def _check_index_version(self):
+        # 只读打开时无法迁移旧格式的索引, 直接使用会读到空的索引
+        db = self._db
+        if db.get(INDEX_VERSION_KEY) == INDEX_VERSION:
+            return
+        if next(iter(db.iter_range(b'd0_', prefix=b'd0_', page_size=1)), None) is None:
+            # 空的数据库
+            return
+        raise ValueError(self.__str__() + '.__init__(): index format is outdated, open it read-write once to migrate')
+
+    def _drop_unbuilt_indexes(self):
+        # 只读打开时无法建立索引, 不使用还没有建立的索引
+        data = self._db.get(INDEX_FIELDS_KEY)
+        if data is None:
+            return
+        built = msgpack.unpackb(data)
+        for key in list(self.index_keys):
+            if key not in built['index']:
+                del self.index_keys[key]
+                del self.range_keys[key]
+        for key in list(self.ngram_keys):
+            if key not in built['ngram'] or key not in self.index_keys:
+                del self.ngram_keys[key]
 
     def ensure_index(self):
+        '''从数据重建所有索引'''
+        self.build_index(list(self.index_keys), list(self.ngram_keys))
+
+    def build_index(self, fields, ngram_fields=()):
+        '''从数据重建 fields 的索引和 ngram_fields 的字词索引, 其他字段的索引不变'''
         db = self._db
-        pk = self.pk
-        index_keys = self.index_keys
-        prefix = b'd0_'
-        keys = db.scan_keys(prefix)
-        pkvals = {}
-        for key in keys:
-            pkval = key[len(prefix):].decode('utf8')
-            pkvals[pkval] = pkval
-        db.put(index_keys[pk], msgpack.packb(pkvals))
-
-        data = {}
-        for key in index_keys:
-            data.setdefault(key, {})
-        for item in self.filter(shallow=True):
-            for key in index_keys:
-                data.setdefault(key, {})
-                val = get_key(item, key)
-                if val is not None:
-                    data[key][item[pk]] = get_key(item, key)
-        batch = {}
-        for key in index_keys:
-            batch[index_keys[key]] = msgpack.packb(data[key])
-        db.multi_put(batch)
+        for key in fields:
+            db.delete_prefix(self.index_keys[key])
+            db.delete_prefix(self.range_keys[key])
+        for key in ngram_fields:
+            db.delete_prefix(self.ngram_keys[key])
+        # 逐条读取 d0_, 每 200 条写入一次索引
+        for records in more_itertools.chunked(db.iter_prefix(b'd0_', values=True), 200):
+            batch = {}
+            for _, data in records:
+                item = _unpackb(data)
+                batch.update(self.get_index_entries(item[self.pk], item, fields, ngram_fields))
+            db.multi_put(batch)
+        db.put(INDEX_VERSION_KEY, INDEX_VERSION)
+        db.put(INDEX_FIELDS_KEY, msgpack.packb(self._index_fields()))
+        # 统计信息中没有新的字段, 重新统计
+        self.analyze()
+        self._touch()
+
+    def get_index_entries(self, pkval, item, fields=None, ngram_fields=None):
+        '''item 的索引项, fields, ngram_fields 为 None 时包括所有字段'''
+        entries = {}
+        fields = self.index_keys if fields is None else fields
+        ngram_fields = self.ngram_keys if ngram_fields is None else ngram_fields
+        for key in fields:
+            val = get_key(item, key)
+            if val is not None:
+                entries[self.get_index_key(key, pkval)] = _packb(val)
+            entries[self.get_range_key(key, pkval, val)] = b''
+        for key in ngram_fields:
+            entries.update(dict.fromkeys(self.get_gram_keys(key, pkval, get_key(item, key)), b''))
+        return entries
+
+    def get_index_key(self, key, pkval):
+        return self.index_keys[key] + pkval.encode('utf8')
+
+    def get_index_keys(self, pkval):
+        return [self.get_index_key(key, pkval) for key in self.index_keys]
+
+    def get_range_key(self, key, pkval, val):
+        return self.range_keys[key] + _encode_sortable(val) + b'\x00' + pkval.encode('utf8')
+
+    def get_gram_keys(self, key, pkval, val):
+        prefix = self.ngram_keys[key]
+        suffix = b'\x00' + pkval.encode('utf8')
+        return [prefix + gram.encode('utf8') + suffix for gram in _ngrams(val)]
 
     def get_meta_key(self, pkval):
         return b'd0_%s' % pkval.encode('utf8')
@@ -135,87 +1242,653 @@ class Table:
     def get_data_key(self, pkval):
         return b'd1_%s' % pkval.encode('utf8')
 
+    def get_series_key(self, pkval, field, year=None):
+        key = b'd2_%s\x00%s' % (pkval.encode('utf8'), field.encode('utf8'))
+        if year is not None:
+            key += b'\x00%04d' % year
+        return key
+
     def get_by_pk(self, pkval, shallow=False):
-        db = self._db
-        if shallow:
-            key = self.get_meta_key(pkval)
-            data = db.get(key)
-            if data:
-                item = msgpack.unpackb(data)
-                _unpack_datetime(item)
-                return item
-        else:
-            keys = [
-                self.get_meta_key(pkval),
-                self.get_data_key(pkval),
-            ]
-            data = db.multi_get(keys)
-            key = keys[0]
-            if key in data and data[key]:
-                item = msgpack.unpackb(data[key])
-                key = keys[1]
-                if key in data and data[key]:
-                    item.update(msgpack.unpackb(data[key]))
-                _unpack_datetime(item)
-                return item
+        for item in self.iter_bulk_get_by_pk([pkval], shallow=shallow):
+            return item
 
     def iter_bulk_get_by_pk(self, pkvals, shallow=False):
+        yield from self._decode_records(pkvals, shallow, self._fetch_records(pkvals, shallow))
+
+    def _fetch_records(self, pkvals, shallow):
+        '''读取 pkvals 的原始数据, 返回 (缓存中的记录, 数据, 缓存的 generation, 数据的字节数), 由 _decode_records 解码'''
         db = self._db
+        cache = self.cache
+        series_keys = self.series_keys
+        cached = {}
+        generation = None
+        if cache is not None:
+            # 其他进程写入过时清空缓存
+            self._get_memo()
+            generation = cache.generation
+            for pkval in pkvals:
+                item = cache.get((pkval, shallow))
+                if item is not None:
+                    cached[pkval] = item
+        missing = [pkval for pkval in pkvals if pkval not in cached]
         if shallow:
-            keys = [self.get_meta_key(pkval) for pkval in pkvals]
+            keys = [self.get_meta_key(pkval) for pkval in missing]
         else:
             keys = []
-            for pkval in pkvals:
+            for pkval in missing:
                 keys.append(self.get_meta_key(pkval))
                 keys.append(self.get_data_key(pkval))
-        data = db.multi_get(keys)
+                for field in series_keys:
+                    keys.append(self.get_series_key(pkval, field))
+        data = db.multi_get(keys) if keys else {}
+        if not shallow and series_keys:
+            # 读取序列的分块
+            keys = []
+            for pkval in missing:
+                for field in series_keys:
+                    key = self.get_series_key(pkval, field)
+                    if key in data:
+                        years, _ = _series_header(data[key])
+                        keys.extend((self.get_series_key(pkval, field, year) for year in years))
+            if keys:
+                data.update(db.multi_get(keys))
+        return cached, data, generation, sum((len(i) for i in data.values()))
+
+    def _decode_records(self, pkvals, shallow, fetched):
+        cache = self.cache
+        series_keys = self.series_keys
+        cached, data, generation, _ = fetched
         for pkval in pkvals:
+            if pkval in cached:
+                yield dict(cached[pkval])
+                continue
             key = self.get_meta_key(pkval)
             if key in data and data[key]:
-                item = msgpack.unpackb(data[key])
+                size = len(data[key])
+                item = _unpackb(data[key])
                 key = self.get_data_key(pkval)
                 if key in data and data[key]:
-                    item.update(msgpack.unpackb(data[key]))
-                _unpack_datetime(item)
+                    size += len(data[key])
+                    item.update(self._unpack_data(data[key]))
+                if not shallow:
+                    for field in series_keys:
+                        key = self.get_series_key(pkval, field)
+                        if key in data:
+                            years, compressed = _series_header(data[key])
+                            chunks = [data[self.get_series_key(pkval, field, year)] for year in years]
+                            size += sum((len(i) for i in chunks))
+                            if compressed:
+                                chunks = [self._decompress_chunk(i) for i in chunks]
+                            item[field] = _concat_series(chunks)
+                if cache is not None:
+                    cache.put((pkval, shallow), item, size, generation)
+                    item = dict(item)
                 yield item
 
-    def bulk_get_by_pk(self, pkvals, shallow=False):
-        return list(self.iter_bulk_get_by_pk(pkvals, shallow=shallow))
+    def get_series(self, pkval, field, start=None, end=None):
+        '''
+        读取序列中 start <= ts <= end 的部分, 只读取有重叠的年度分块
 
-    def _filter(self, q=None, shallow=False):
+        start, end 可以是毫秒时间戳, 或者 day2msts() 支持的日期
+        '''
         db = self._db
-        index_keys = self.index_keys
-        pkvals = self.list_pk()
+        start = _to_msts(start)
+        end = _to_msts(end)
+        data = db.get(self.get_series_key(pkval, field))
+        if data is None:
+            # 未分块保存的序列
+            item = self.get_by_pk(pkval)
+            series = item.get(field) if item else None
+            if not isinstance(series, np.ndarray):
+                return series
+        else:
+            years, compressed = _series_header(data)
+            if start is not None:
+                years = [i for i in years if i >= _msts_year(start)]
+            if end is not None:
+                years = [i for i in years if i <= _msts_year(end)]
+            keys = [self.get_series_key(pkval, field, year) for year in years]
+            data = db.multi_get(keys)
+            chunks = [data[key] for key in keys if key in data]
+            if compressed:
+                chunks = [self._decompress_chunk(i) for i in chunks]
+            series = _concat_series(chunks)
+        if start is not None:
+            series = series[series['ts'] >= start]
+        if end is not None:
+            series = series[series['ts'] <= end]
+        return series
+
+    def _pack_data(self, data):
+        for key in self.series_keys:
+            if key in data:
+                data[key] = _to_series(data[key])
+        return self._compress_data(_packb(data))
+
+    def _unpack_data(self, data):
+        data = _unpackb(self._decompress_data(data))
+        # 旧格式的序列为 [[ts, value, change], ...]
+        for key in self.series_keys:
+            if isinstance(data.get(key), list):
+                data[key] = _to_series(data[key])
+        return data
+
+    def _compress_data(self, data, use_dictionary=True):
+        if self.compression is None:
+            return data
+        codec = CODECS[self.compression]
+        header = bytes([codec])
+        zdict = None
+        if use_dictionary and self._dictionary_id is not None:
+            header = bytes([codec | _CODEC_DICT]) + self._dictionary_id
+            zdict = self._get_dictionary(self._dictionary_id)
+        compressed = header + _compress(self.compression, data, self.compression_level, zdict)
+        # 压缩后没有变小时保存原始数据
+        return compressed if len(compressed) < len(data) else data
+
+    def _decompress_data(self, data):
+        if data[0] >= 0x80:
+            return data
+        codec = data[0] & ~_CODEC_DICT
+        name = _CODEC_NAMES.get(codec)
+        if name is None or not _codec_available(name):
+            raise ValueError(self.__str__() + '._decompress_data(): compression %d not available' % codec)
+        if data[0] & _CODEC_DICT:
+            return _decompress(name, data[5:], self._get_dictionary(data[1:5]))
+        return _decompress(name, data[1:])
+
+    def _compress_chunk(self, chunk):
+        # 字典由 d1_ 训练, 对数值数组没有帮助, 分块不使用字典
+        data = self._compress_data(chunk, use_dictionary=False)
+        # 没有变小时 _compress_data 返回原始数据, 加上标记与压缩的数据区分
+        return data if data is not chunk else _CHUNK_RAW + chunk
+
+    def _decompress_chunk(self, data):
+        if data[:1] == _CHUNK_RAW:
+            return data[1:]
+        return self._decompress_data(data)
+
+    def _pack_series(self, chunks):
+        '''返回 {year: 写入的分块} 和年份列表, compression 不为 None 时压缩分块'''
+        years = list(chunks)
+        if self.compression is None:
+            return {year: chunk.tobytes() for year, chunk in chunks.items()}, msgpack.packb(years)
+        packed = {year: self._compress_chunk(chunk.tobytes()) for year, chunk in chunks.items()}
+        return packed, msgpack.packb({'years': years, 'compressed': True})
+
+    def _get_dictionary(self, dictionary_id):
+        if dictionary_id not in self._dictionaries:
+            zdict = self._db.get(DICT_KEY + b'\x00' + dictionary_id)
+            if zdict is None:
+                raise ValueError(self.__str__() + '._get_dictionary(): dictionary %s not found' % dictionary_id.hex())
+            self._dictionaries[dictionary_id] = zdict
+        return self._dictionaries[dictionary_id]
+
+    def _sample_data(self, samples):
+        '''均匀抽取最多 samples 条 d1_ 的原始数据 (解压后)'''
+        keys = self._db.scan_keys(b'd1_')
+        step = max(1, len(keys) // samples)
+        data = self._db.multi_get(keys[::step][:samples])
+        return [self._decompress_data(i) for i in data.values() if i]
+
+    def _sample_chunks(self, samples):
+        '''均匀抽取序列, 返回其中最多 samples 个分块的原始数据 (解压后)'''
+        count = sum((1 for key in self._db.iter_prefix(b'd2_') if key.count(b'\x00') == 1))
+        data = []
+        for _, chunks, _ in self._iter_series(step=max(1, count // samples)):
+            data.extend(chunks.values())
+            if len(data) >= samples:
+                break
+        return data[:samples]
+
+    def train_dictionary(self, samples=1000, dict_size=64 * 1024):
+        '''
+        用已有的 d1_ 训练压缩字典, 之后写入的 d1_ 使用该字典压缩; 旧的字典仍然保留, 用于读取旧数据
+
+        zstd 使用 zstandard.train_dictionary(), 其他算法使用样本拼接的结尾部分作为预置字典
+        (zlib 只使用最后 32KB)
+        '''
+        if self.compression is None:
+            raise ValueError(self.__str__() + '.train_dictionary(): compression not enabled')
+        data = self._sample_data(samples)
+        if not data:
+            raise ValueError(self.__str__() + '.train_dictionary(): no data')
+        zdict = _train_dictionary(self.compression, data, dict_size)
+        dictionary_id = struct.pack('>I', zlib.crc32(zdict))
+        db = self._db
+        db.put(DICT_KEY + b'\x00' + dictionary_id, zdict)
+        db.put(DICT_KEY, dictionary_id)
+        self._dictionaries[dictionary_id] = zdict
+        self._dictionary_id = dictionary_id
+        return dictionary_id
+
+    def recompress(self):
+        '''按当前的压缩设置重写所有 d1_ 和序列分块, 返回 (重写前的字节数, 重写后的字节数)'''
+        db = self._db
+        before = after = 0
+        for records in more_itertools.chunked(db.iter_prefix(b'd1_', values=True), 200):
+            batch = {}
+            for key, data in records:
+                before += len(data)
+                if data:
+                    data = self._compress_data(self._decompress_data(data))
+                batch[key] = data
+                after += len(data)
+            db.multi_put(batch)
+        # 序列的年份列表排在它的分块之前, 一个序列的年份列表和分块一起写入
+        batch = {}
+        for series_key, chunks, size in self._iter_series():
+            before += size
+            packed, header = self._pack_series({
+                year: np.frombuffer(chunk, dtype=SERIES_DTYPE) for year, chunk in chunks.items()
+            })
+            batch[series_key] = header
+            for year, chunk in packed.items():
+                batch[series_key + b'\x00%04d' % year] = chunk
+            after += len(header) + sum((len(i) for i in packed.values()))
+            if len(batch) >= 200:
+                db.multi_put(batch)
+                batch = {}
+        db.multi_put(batch)
+        db.checkpoint()
+        return before, after
 
+    def _iter_series(self, step=1):
+        '''遍历序列, 返回 (年份列表的 key, {year: 解压后的分块}, 保存的字节数), step 大于 1 时每 step 个序列取一个'''
+        db = self._db
+        index = -1
+        for series_key in db.iter_prefix(b'd2_'):
+            if series_key.count(b'\x00') != 1:
+                continue
+            index += 1
+            if index % step:
+                continue
+            header = db.get(series_key)
+            if header is None:
+                continue
+            years, compressed = _series_header(header)
+            keys = [series_key + b'\x00%04d' % year for year in years]
+            data = db.multi_get(keys)
+            chunks = {}
+            size = len(header)
+            for year, key in zip(years, keys):
+                if key in data:
+                    size += len(data[key])
+                    chunks[year] = self._decompress_chunk(data[key]) if compressed else data[key]
+            yield series_key, chunks, size
+
+    def compression_report(self, samples=500, dict_size=64 * 1024):
+        '''
+        抽样比较各压缩算法 (及使用字典时) 的效果, 返回 [{...}, ...]:
+        数据 (d1_ 或 d2_ 序列分块), 压缩前后的字节数, 节省的比例, 每条记录的压缩和解压耗时 (毫秒);
+        字典用同一批样本训练, 序列分块不使用字典
+        '''
+        report = []
+        for prefix, data in (('d1_', self._sample_data(samples)), ('d2_', self._sample_chunks(samples))):
+            if data:
+                report.extend(self._compression_report(prefix, data, dict_size if prefix == 'd1_' else None))
+        return report
+
+    def _compression_report(self, prefix, data, dict_size):
+        raw = sum((len(i) for i in data))
+        report = []
+        for name in CODECS:
+            if not _codec_available(name):
+                continue
+            zdicts = [None] if dict_size is None else [None, _train_dictionary(name, data, dict_size)]
+            for zdict in zdicts:
+                start = time.perf_counter()
+                compressed = [_compress(name, i, self.compression_level, zdict) for i in data]
+                compress_cost = time.perf_counter() - start
+                start = time.perf_counter()
+                for i in compressed:
+                    _decompress(name, i, zdict)
+                decompress_cost = time.perf_counter() - start
+                size = sum((len(i) for i in compressed))
+                report.append({
+                    'data': prefix,
+                    'codec': name,
+                    'dictionary': zdict is not None,
+                    'count': len(data),
+                    'raw_bytes': raw,
+                    'compressed_bytes': size,
+                    'saved': 1 - size / raw,
+                    'compress_ms': compress_cost * 1000 / len(data),
+                    'decompress_ms': decompress_cost * 1000 / len(data),
+                })
+        return report
+
+    def bulk_get_by_pk(self, pkvals, shallow=False):
+        return list(self.iter_bulk_get_by_pk(pkvals, shallow=shallow))
+
+    def _candidates(self, q=None, shallow=False):
+        '''返回 (pkvals, sure): 需要读取的主键, 其中 sure 中的记录不需要逐条匹配'''
+        pkvals = None
+        sure = set()
         if q:
-            db_keys = []
-            for key in q.keys():
-                if key.split('.')[0] in index_keys:
-                    key = key.split('.')[0]
-                if key in index_keys:
-                    db_key = index_keys[key]
-                    db_keys.append(db_key)
-            if db_keys:
-                db_data = db.multi_get(db_keys)
-                data = {k: msgpack.unpackb(v) for k, v in db_data.items()}
-                index = {}
-                for key, db_key in index_keys.items():
-                    if db_key in data:
-                        for k, v in data[db_key].items():
-                            index.setdefault(k, {})
-                            put_key(index[k], key, v)
-                pkvals = [i for i in pkvals if q.match(index.get(i, {}), shallow_match=True)]
-
-        if not isinstance(pkvals, list):
-            pkvals = list(pkvals)
-        for _pkvals in more_itertools.sliced(pkvals, 200):
-            for item in self.iter_bulk_get_by_pk(_pkvals, shallow=shallow):
-                if q:
-                    if q.match(item):
+            plan = self.plan(q, shallow=shallow)
+            sure, maybe = plan.execute()
+            if maybe is not None:
+                pkvals = sorted(maybe)
+        if pkvals is None:
+            pkvals = self.list_pk()
+        return pkvals, sure
+
+    def _filter(self, q=None, shallow=False, pkvals=None, limit=None):
+        '''
+        pkvals 不为 None 时为已知满足 q 的主键 (缓存的查询结果), 只在查询期间有写入时逐条匹配;
+        limit 为调用者需要的记录数, 不确定时为 None
+        '''
+        pk = self.pk
+        if q:
+            match = q.compile()
+        generation = self.generation
+        if pkvals is None:
+            pkvals, sure = self._candidates(q, shallow=shallow)
+        else:
+            sure = set(pkvals)
+        for items in self._iter_read_ahead(pkvals, shallow, limit):
+            if sure and self.generation != generation:
+                # 查询期间有写入, 索引确定匹配的结果可能已过期, 逐条匹配
+                sure = set()
+            for item in items:
+                if q and item[pk] not in sure:
+                    if match(item):
                         yield item
                 else:
                     yield item
 
+    def _query_key(self, q, shallow):
+        # Q 不涉及 heavy_keys 时, shallow 不影响结果
+        heavy_keys = self.heavy_keys
+        shallow = shallow and any((key.split('.')[0] in heavy_keys for key in q.keys()))
+        return (q.canonical(), shallow)
+
+    def get_query_db_key(self, query_key):
+        canonical, shallow = query_key
+        digest = hashlib.sha1(('%s\x00%d' % (canonical, shallow)).encode('utf8')).hexdigest()
+        return b'q_%s' % digest.encode('ascii')
+
+    def get_query_cache(self, q, shallow=False):
+        '''
+        缓存的查询结果 (满足 q 的主键, 按主键排序), 没有缓存时返回 None
+
+        结果缓存在 generation 的 memo 中, 写入后失效; persist_queries 为 True 时同时保存在 q_ 中,
+        与 m_generation 一起保存, 数据库写入过后失效
+        '''
+        memo = self._get_memo()
+        queries = memo.setdefault('queries', OrderedDict())
+        key = self._query_key(q, shallow)
+        if key in queries:
+            queries.move_to_end(key)
+            return queries[key]
+        if self.persist_queries and self._db_generation is not None:
+            data = self._db.get(self.get_query_db_key(key))
+            if data is not None:
+                token, pkvals = msgpack.unpackb(data)
+                if token == self._db_generation:
+                    self._put_query_memo(key, pkvals)
+                    return pkvals
+        return None
+
+    def put_query_cache(self, q, shallow, pkvals, generation):
+        '''缓存查询结果, generation 为开始查询前的 self.generation, 查询期间有写入时不缓存'''
+        if generation != self.generation:
+            return
+        key = self._query_key(q, shallow)
+        self._put_query_memo(key, pkvals)
+        if self.persist_queries and self._db_generation is not None and not self._db.readonly:
+            self._db.put(self.get_query_db_key(key), msgpack.packb([self._db_generation, pkvals]))
+
+    def _put_query_memo(self, key, pkvals):
+        queries = self._memo.setdefault('queries', OrderedDict())
+        queries[key] = pkvals
+        if len(queries) > QUERY_CACHE_SIZE:
+            queries.popitem(last=False)
+
+    def clear_query_cache(self):
+        '''删除缓存的查询结果, 包括保存在数据库中的'''
+        self._memo.pop('queries', None)
+        self._db.delete_prefix(b'q_')
+
+    def _query_pks(self, q, shallow=False):
+        '''满足 q 的主键 (按主键排序), 优先使用缓存, 其次只使用索引计算, 需要读取记录时返回 None'''
+        pkvals = self.get_query_cache(q, shallow)
+        if pkvals is None:
+            generation = self.generation
+            pkvals = self._filter_pks(q)
+            if pkvals is not None:
+                self.put_query_cache(q, shallow, pkvals, generation)
+        return pkvals
+
+    def _filter_cached(self, q, shallow):
+        '''与 _filter 相同, 有缓存时只读取结果中的记录, 否则完整遍历后缓存结果'''
+        pkvals = self.get_query_cache(q, shallow)
+        if pkvals is not None:
+            yield from self._filter(q, shallow, pkvals)
+            return
+        generation = self.generation
+        pk = self.pk
+        pkvals = []
+        for item in self._filter(q, shallow):
+            pkvals.append(item[pk])
+            yield item
+        self.put_query_cache(q, shallow, pkvals, generation)
+
+    def _iter_read_ahead(self, pkvals, shallow, limit=None):
+        '''
+        按顺序读取 pkvals 的记录, 每次返回一个分片的记录列表
+
+        后台线程预读之后的 READ_AHEAD_DEPTH 个分片, 调用者匹配当前分片时下一个分片已在读取;
+        分片大小按已读取记录的平均字节数调整, 使每个分片约为 READ_AHEAD_BYTES.
+        只有一个分片, 或当前线程在事务中 (其他线程读不到未提交的数据) 时不预读;
+        调用者只需要 limit 条记录时先只读取前 limit 条, 有记录不满足条件需要更多时再继续
+        '''
+        if limit is not None and limit < min(len(pkvals), READ_AHEAD_SLICE):
+            yield list(self.iter_bulk_get_by_pk(pkvals[:limit], shallow=shallow))
+            pkvals = pkvals[limit:]
+        size = READ_AHEAD_SLICE
+        depth = READ_AHEAD_DEPTH
+        if not depth or len(pkvals) <= size or self._db.in_transaction():
+            for _pkvals in more_itertools.sliced(pkvals, size):
+                yield list(self.iter_bulk_get_by_pk(_pkvals, shallow=shallow))
+            return
+        executor = _read_ahead_executor()
+        pending = deque()
+        start = 0
+        try:
+            while start < len(pkvals) or pending:
+                while start < len(pkvals) and len(pending) < depth:
+                    _pkvals = pkvals[start:start + size]
+                    start += len(_pkvals)
+                    pending.append((_pkvals, executor.submit(self._fetch_records, _pkvals, shallow)))
+                _pkvals, future = pending.popleft()
+                fetched = future.result()
+                nbytes = fetched[3]
+                if nbytes:
+                    size = int(READ_AHEAD_BYTES * len(_pkvals) / nbytes)
+                    size = min(max(size, READ_AHEAD_MIN_SLICE), READ_AHEAD_MAX_SLICE)
+                yield list(self._decode_records(_pkvals, shallow, fetched))
+        finally:
+            # 调用者提前结束时取消还没有开始的预读
+            for _, future in pending:
+                future.cancel()
+
+    def _filter_pks(self, q=None):
+        '''只使用索引计算满足 Q 的主键 (按主键排序), Q 中有未索引的字段时返回 None'''
+        if q is None:
+            return self.list_pk()
+        if None in {self.index_field(key) for key in q.keys()}:
+            return None
+        sure, maybe = self.plan(q).execute()
+        if maybe is None:
+            # 需要检查全表, 在索引列上向量化计算
+            mask = self.eval_columns(q)
+            return self.get_column_pks()[mask].tolist()
+        unsure = [pkval for pkval in maybe if pkval not in sure]
+        fields = {self.index_field(key) for key in q.keys()}
+        rows = self.load_index_rows(fields, unsure)
+        match = q.compile()
+        pkvals = set(sure)
+        pkvals.update((pkval for pkval in unsure if match(rows.get(pkval, {}))))
+        return sorted(pkvals)
+
+    def project(self, pkvals, fields):
+        '''从索引中读取字段, 返回 [[value, ...], ...], 字段必须是 index_keys 中的顶层字段'''
+        columns = []
+        for field in fields:
+            if field == self.pk:
+                columns.append(pkvals)
+                continue
+            if ('index', field) in self._memo or len(pkvals) * 4 >= len(self.get_column_pks()):
+                index = self.load_index(field)
+                values = [index.get(pkval) for pkval in pkvals]
+            else:
+                db_keys = [self.get_index_key(field, pkval) for pkval in pkvals]
+                db_data = self._db.multi_get(db_keys)
+                values = [
+                    _unpackb(db_data[db_key]) if db_key in db_data else None
+                    for db_key in db_keys
+                ]
+            columns.append(values)
+        return [list(i) for i in zip(*columns)]
+
+    def _order_pks(self, q, order, count=None):
+        '''
+        只使用索引排序, 返回 (pkvals, exact), 排序字段未索引时返回 None
+
+        exact 为 False 时 pkvals 是按顺序排列的候选主键, 需要读取记录后逐条匹配;
+        count 不为 None 时只需要前 count 个结果
+        '''
+        order = _parse_order(order)
+        if any((self.index_field(field) is None for field, _ in order)):
+            return None
+        pkvals = self._filter_pks(q)
+        exact = pkvals is not None
+        if not exact:
+            sure, maybe = self.plan(q).execute()
+            pkvals = self.list_pk() if maybe is None else sorted(maybe)
+        if count is not None and exact and len(order) == 1 and order[0][0] in self.range_keys:
+            # 按有序索引的顺序读取主键
+            field, reverse = order[0]
+            return list(itertools.islice(self._iter_range_order(field, reverse, set(pkvals)), count)), True
+        if len(pkvals) * 4 >= len(self.get_column_pks()):
+            # 使用缓存的索引
+            columns = []
+            for field, _ in order:
+                # index_field() 返回最长的有索引的前缀, 剩余部分从索引值中读取
+                index_field = self.index_field(field)
+                index = self.load_index(index_field)
+                if field == index_field:
+                    columns.append([index.get(pkval) for pkval in pkvals])
+                else:
+                    subkey = field[len(index_field) + 1:]
+                    values = (index.get(pkval) for pkval in pkvals)
+                    columns.append([None if i is None else get_key(i, subkey) for i in values])
+        else:
+            fields = {self.index_field(field) for field, _ in order}
+            rows = self.load_index_rows(fields, pkvals)
+            columns = [[get_key(rows.get(pkval, {}), field) for pkval in pkvals] for field, _ in order]
+        keys = {
+            pkval: _order_key(values, order, pkval)
+            for pkval, values in zip(pkvals, zip(*columns))
+        }
+        if count is not None and exact:
+            return heapq.nsmallest(count, pkvals, key=keys.get), True
+        return sorted(pkvals, key=keys.get), exact
+
+    def _iter_range_order(self, field, reverse, pkvals):
+        # 有序索引中值相同的主键按升序排列, 缺失值排在最后
+        db = self._db
+        prefix = self.range_keys[field]
+        nulls = [db_key.rpartition(b'\x00')[2].decode('utf8') for db_key in db.iter_prefix(prefix + _SORT_NULL)]
+        start = prefix + bytes([_SORT_NULL[0] + 1])
+        entries = (db_key[len(prefix):].rpartition(b'\x00') for db_key in db.iter_range(start, prefix=prefix))
+        if not reverse:
+            # 升序时按索引顺序逐条读取, 得到足够的结果后停止
+            for _, _, pkval in entries:
+                pkval = pkval.decode('utf8')
+                if pkval in pkvals:
+                    yield pkval
+        else:
+            groups = [
+                [pkval.decode('utf8') for _, _, pkval in group]
+                for _, group in itertools.groupby(entries, key=operator.itemgetter(0))
+            ]
+            for group in reversed(groups):
+                for pkval in group:
+                    if pkval in pkvals:
+                        yield pkval
+        for pkval in nulls:
+            if pkval in pkvals:
+                yield pkval
+
+    def _filter_ordered(self, q, shallow, order, offset=0, limit=None):
+        count = None if limit is None else offset + limit
+        if count == 0:
+            return
+        result = self._order_pks(q, order, count)
+        if result is not None:
+            pkvals, exact = result
+            if exact:
+                yield from self.iter_bulk_get_by_pk(pkvals[offset:count], shallow=shallow)
+                return
+            # 候选主键已排序, 逐条匹配直到得到足够的结果
+            match = q.compile()
+            it = (
+                item
+                for _pkvals in more_itertools.sliced(pkvals, 200)
+                for item in self.iter_bulk_get_by_pk(_pkvals, shallow=shallow)
+                if match(item)
+            )
+            yield from itertools.islice(it, offset, count)
+            return
+        # 排序字段未索引, 读取记录后用堆选出前 count 个
+        order = _parse_order(order)
+        keys = [field for field, _ in order]
+        if q is not None:
+            keys.extend(q.keys())
+        # 不涉及 heavy_keys 时, 在 shallow 记录上排序, 再读取选中的完整记录
+        refetch = not shallow and all((key.split('.')[0] not in self.heavy_keys for key in keys))
+        items = self._filter(q, shallow=shallow or refetch)
+        key = lambda x: _order_key([get_key(x, field) for field, _ in order], order, x[self.pk])
+        if count is None:
+            items = sorted(items, key=key)[offset:]
+        else:
+            items = heapq.nsmallest(count, items, key=key)[offset:]
+        if not refetch:
+            yield from items
+            return
+        pkvals = [item[self.pk] for item in items]
+        for _pkvals in more_itertools.sliced(pkvals, 200):
+            yield from self.iter_bulk_get_by_pk(_pkvals, shallow=False)
+
+    def _iter_parallel(self, pkvals, sure, q, shallow, workers=None, func=None, chunk_size=200):
+        '''
+        在子进程中读取, 解码并匹配记录, 按 pkvals 的顺序返回
+
+        每个子进程以只读方式打开数据库, sure 为 None 时不需要匹配
+        '''
+        workers = workers or os.cpu_count()
+        config = (self.db_uri, self.name, self.pk, self.indexes, self.heavy_keys, self.series_keys, self.backend)
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_parallel_init,
+            initargs=(config, q, shallow, func),
+        )
+        try:
+            # 最多同时提交 workers * 2 个分片, 避免结果堆积在内存中
+            pending = deque()
+            for _pkvals in more_itertools.sliced(pkvals, chunk_size):
+                _sure = None if sure is None else {pkval for pkval in _pkvals if pkval in sure}
+                pending.append(executor.submit(_parallel_work, _pkvals, _sure))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
     def filter(self, q=None, shallow=False, **kwargs):
         if q is None and kwargs:
             q = Q.from_kwargs(kwargs)
@@ -237,114 +1910,938 @@ class Table:
         db = self._db
         if self.pk not in item and not isinstance(item[self.pk], str):
             raise ValueError(self.__str__() + '.save(): primary key not valid')
+        self._stats_changes += 1
+        pkval = item[self.pk]
+        if self.cache is not None:
+            self.cache.invalidate(pkval)
+        with self._views_transaction():
+            db_data = None
+            if not do_not_update_cache:
+                db_data = db.multi_get(self.get_index_keys(pkval))
+            batch, deleted = self._prepare_save(item, db_data)
+            batch.update(self._update_views({pkval: item}))
+            # 写入数据库, 写入前先更新 generation, 让并发的查询重新匹配读到的记录
+            self.generation += 1
+            db.multi_put(batch)
+            for db_key in deleted:
+                db.delete(db_key)
+        if self.cache is not None:
+            # 写入前后都要清除: 写入期间开始的读取可能记下新的 generation 后读到旧数据
+            self.cache.invalidate(pkval)
+        self._touch()
+
+    @contextlib.contextmanager
+    def _views_transaction(self):
+        # 有视图时, 视图的读取, 更新和写入与记录在同一个事务中, 避免并发的 save 互相覆盖
+        if not self.views:
+            yield
+            return
+        db = self._db
+        db.begin()
+        try:
+            yield
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+
+    def get_view_key(self, name):
+        return b'v_%s' % name.encode('utf8')
+
+    def get_view_def_key(self, name):
+        return b'm_view\x00%s' % name.encode('utf8')
+
+    def create_view(self, name, q, fields=()):
+        '''
+        注册视图: 满足 q 的记录的主键和 fields 中的字段保存在一条记录中, 由 save, delete 更新,
+        get_view() 只需要读取一条记录
+
+        数据库中的视图定义不同 (或没有视图) 时从数据重建视图
+        '''
+        view = View(self, name, q, fields)
+        self.views[name] = view
+        if self._db.readonly:
+            return view
+        definition = self._db.get(self.get_view_def_key(name))
+        if definition != view.definition() or self._db.get(self.get_view_key(name)) is None:
+            self.rebuild_view(name)
+        return view
+
+    def rebuild_view(self, name):
+        '''读取满足视图条件的记录, 重建视图'''
+        view = self.views[name]
+        db = self._db
+        # 重建期间其他线程不能写入
+        db.begin()
+        try:
+            rows = {
+                item[self.pk]: view.project(item)
+                for item in self._filter(view.q, shallow=view.shallow)
+            }
+            db.put(self.get_view_key(name), _packb(rows))
+            db.put(self.get_view_def_key(name), view.definition())
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        self._memo.pop(('view', name), None)
+
+    def drop_view(self, name):
+        self.views.pop(name, None)
+        self._db.delete(self.get_view_key(name))
+        self._db.delete(self.get_view_def_key(name))
+        self._memo.pop(('view', name), None)
+
+    def get_view(self, name):
+        '''返回视图中的记录 [{pk: ..., field: ...}, ...], 按主键排序, 调用者不应修改'''
+        if name not in self.views:
+            raise ValueError(self.__str__() + '.get_view(): view %s not found' % name)
+        memo = self._get_memo()
+        if ('view', name) not in memo:
+            view = self.views[name]
+            data = self._db.get(self.get_view_key(name))
+            if data is None:
+                # 只读打开, 视图还没有建立
+                rows = {item[self.pk]: view.project(item) for item in self._filter(view.q, shallow=view.shallow)}
+            else:
+                rows = _unpackb(data)
+            result = []
+            for pkval in sorted(rows):
+                row = {self.pk: pkval}
+                for field, value in zip(view.fields, rows[pkval]):
+                    put_key(row, field, value)
+                result.append(row)
+            memo[('view', name)] = result
+        return memo[('view', name)]
+
+    def _update_views(self, changes):
+        '''changes 为 {pk: 新的记录, 删除时为 None}, 返回需要写入的视图数据, 需要在事务中调用'''
+        batch = {}
+        for name, view in self.views.items():
+            db_key = self.get_view_key(name)
+            data = self._db.get(db_key)
+            rows = _unpackb(data) if data else {}
+            changed = False
+            for pkval, item in changes.items():
+                if item is not None and view.match(item):
+                    rows[pkval] = view.project(item)
+                    changed = True
+                elif pkval in rows:
+                    del rows[pkval]
+                    changed = True
+            if changed:
+                batch[db_key] = _packb(rows)
+        return batch
+
+    def _prepare_save(self, item, db_data):
+        '''
+        返回保存 item 需要写入的 batch 和需要删除的 key
+
+        db_data 中是 multi_get 读取的本条记录的索引项, 为 None 时不更新索引
+        '''
+        db = self._db
         index_keys = self.index_keys
-        heavy_keys = self.heavy_keys
-        _pack_datetime(item)
         batch = {}
         pkval = item[self.pk]
-        if not do_not_update_cache:
-            # 更新索引
-            db_data = db.multi_get(list(index_keys.values()))
-            db_data = {k: msgpack.unpackb(v) for k, v in db_data.items()}
-            for key, db_key in index_keys.items():
-                data = db_data[db_key]
+        deleted = []
+        # 不更新索引时无法判断记录是否存在
+        exists = db_data is None or self.get_index_key(self.pk, pkval) in db_data
+        if db_data is not None:
+            # 更新索引, 只读写本条记录对应的索引项
+            for key in index_keys:
+                db_key = self.get_index_key(key, pkval)
                 val = get_key(item, key)
-                if data.get(pkval) != val:
-                    data[pkval] = val
-                    batch[db_key] = msgpack.packb(data)
+                old = db_data.get(db_key)
+                packed = None if val is None else _packb(val)
+                if exists and packed == old:
+                    continue
+                if packed is not None:
+                    batch[db_key] = packed
+                elif old is not None:
+                    deleted.append(db_key)
+                range_key = self.get_range_key(key, pkval, val)
+                batch[range_key] = b''
+                if exists:
+                    old = None if old is None else _unpackb(old)
+                    old_range_key = self.get_range_key(key, pkval, old)
+                    if old_range_key != range_key:
+                        deleted.append(old_range_key)
+                if key in self.ngram_keys:
+                    gram_keys = self.get_gram_keys(key, pkval, val)
+                    batch.update(dict.fromkeys(gram_keys, b''))
+                    if exists:
+                        deleted.extend(set(self.get_gram_keys(key, pkval, old)) - set(gram_keys))
         # 更新 item 数据
         heavy_keys = self.heavy_keys
         _data = {k: v for k, v in item.items() if k in heavy_keys}
         _meta = {k: v for k, v in item.items() if k not in _data}
         meta_key = self.get_meta_key(pkval)
         data_key = self.get_data_key(pkval)
-        batch[meta_key] = msgpack.packb(_meta)
-        batch[data_key] = msgpack.packb(_data)
-        # 写入数据库
-        db.multi_put(batch)
+        batch[meta_key] = _packb(_meta)
+        # 序列按年分块保存, 旧的分块与新的一起写入或删除, 不在写入 batch 之前单独删除
+        for field in self.series_keys:
+            series = _data.get(field)
+            chunks = _split_series(_to_series(series)) if series is not None else None
+            if chunks:
+                _data.pop(field)
+                packed, header = self._pack_series(chunks)
+                batch[self.get_series_key(pkval, field)] = header
+                for year, chunk in packed.items():
+                    batch[self.get_series_key(pkval, field, year)] = chunk
+            if exists:
+                series_key = self.get_series_key(pkval, field)
+                old = db.get(series_key)
+                if old is not None:
+                    old_keys = [series_key]
+                    old_keys.extend((self.get_series_key(pkval, field, year) for year in _series_header(old)[0]))
+                    deleted.extend((db_key for db_key in old_keys if db_key not in batch))
+        batch[data_key] = self._pack_data(_data)
+        return batch, deleted
 
     def bulk_save(self, items):
-        for item in items:
-            self.save(item, do_not_update_cache=True)
-        self.ensure_index()
+        with self.bulk_writer() as writer:
+            for item in items:
+                writer.save(item)
+
+    def bulk_writer(self, buffer_size=500, checkpoint=True):
+        '''
+        批量写入, 在一个事务中完成
+
+            with Fund.bulk_writer() as writer:
+                for fund in funds:
+                    writer.save(fund)
+        '''
+        return BulkWriter(self, buffer_size=buffer_size, checkpoint=checkpoint)
+
+    def write_behind(self, batch_size=500, interval=0.2, max_pending=5000, durable=True):
+        '''
+        后台写入, 多个线程调用 writer.save() 时只放入队列, 由一个写线程批量写入
+
+            with Fund.write_behind() as writer:
+                pool.map(lambda code: writer.save(crawl(code)), codes)
+
+        batch_size: 每攒够 batch_size 条, 或距离第一条等待写入的记录超过 interval 秒, 写入一次
+        max_pending: 队列中最多的记录数, 队列满时 save() 阻塞
+        durable: 为 True 时每批写入后 checkpoint, 为 False 时由自动 checkpoint 完成, 写入更快,
+            但进程崩溃时可能丢失最近的几批
+        '''
+        return WriteBehind(self, batch_size=batch_size, interval=interval, max_pending=max_pending,
+                           durable=durable)
 
     def delete(self, pkval):
+        self.delete_many([pkval])
+
+    def delete_many(self, pkvals):
+        '''删除多条记录, 在一个事务中完成, 每 200 条一起读取索引项'''
         db = self._db
-        index_keys = self.index_keys
+        pkvals = list(pkvals)
+        self._stats_changes += len(pkvals)
+        db.begin()
+        try:
+            for _pkvals in more_itertools.sliced(pkvals, 200):
+                # 删除索引
+                db_data = db.multi_get([key for pkval in _pkvals for key in self.get_index_keys(pkval)])
+                for pkval in _pkvals:
+                    if self.cache is not None:
+                        self.cache.invalidate(pkval)
+                    for key in self.index_keys:
+                        db_key = self.get_index_key(key, pkval)
+                        old = db_data.get(db_key)
+                        if old is not None:
+                            db.delete(db_key)
+                            old = _unpackb(old)
+                        db.delete(self.get_range_key(key, pkval, old))
+                        if key in self.ngram_keys:
+                            for gram_key in self.get_gram_keys(key, pkval, old):
+                                db.delete(gram_key)
+                    # 删除数据
+                    db.delete(self.get_meta_key(pkval))
+                    db.delete(self.get_data_key(pkval))
+                    db.delete_prefix(b'd2_%s\x00' % pkval.encode('utf8'))
+                db.multi_put(self._update_views(dict.fromkeys(_pkvals)))
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        finally:
+            if self.cache is not None:
+                # 提交前读到的旧数据可能已写入缓存
+                for pkval in pkvals:
+                    self.cache.invalidate(pkval)
+            self._touch()
+        return len(pkvals)
+
+
+class BulkWriter:
+    '''
+    批量写入: 记录先缓存在内存中, 每 buffer_size 条一起读取旧索引项, 生成新的索引项后一次写入,
+    整个过程在一个事务中, 期间不自动 checkpoint, 结束时提交; 发生异常时回滚
+    checkpoint 为 False 时结束后不立即 checkpoint, 由自动 checkpoint 完成
+    '''
+    def __init__(self, table, buffer_size=500, checkpoint=True):
+        self.table = table
+        self.buffer_size = buffer_size
+        self.checkpoint = checkpoint
+        self.count = 0
+        self._items = {}
+        # 写入过的主键, 提交后从缓存中清除
+        self._written = set()
+        self._autocheckpoint = None
+
+    def __str__(self):
+        return '<BulkWriter #%s %d items>' % (self.table.name, self.count)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __enter__(self):
+        db = self.table._db
+        db.begin()
+        # 持有写锁时保存和恢复 autocheckpoint, 并发的 BulkWriter 不会互相覆盖
+        try:
+            self._autocheckpoint = db.set_autocheckpoint(0)
+        except BaseException:
+            db.rollback()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        table = self.table
+        db = table._db
+        try:
+            try:
+                if exc_type is None:
+                    self.flush()
+                    table.generation += 1
+            finally:
+                db.set_autocheckpoint(self._autocheckpoint)
+        except BaseException:
+            # 最后一次 flush 出错时也要回滚, 否则事务和写锁不会释放
+            db.rollback()
+            raise
+        else:
+            if exc_type is None:
+                db.commit()
+            else:
+                db.rollback()
+        finally:
+            if table.cache is not None:
+                # 事务进行中其他线程读到的是旧数据, 提交或回滚后清除
+                for pkval in self._written:
+                    table.cache.invalidate(pkval)
+            self._written = set()
+            if self.checkpoint:
+                db.checkpoint()
+            table._stats_changes += self.count
+            table._touch()
+            if exc_type is None and table._stats_stale():
+                # 批量写入后统计信息已过时, 重新统计并保存, 其他进程打开时直接使用
+                table.analyze()
+
+    def save(self, item):
+        table = self.table
+        if table.pk not in item and not isinstance(item[table.pk], str):
+            raise ValueError(self.__str__() + '.save(): primary key not valid')
+        # 同一主键只保留最后一次写入
+        self._items.pop(item[table.pk], None)
+        self._items[item[table.pk]] = item
+        self.count += 1
+        if len(self._items) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        table = self.table
+        db = table._db
+        if not self._items:
+            return
+        items = list(self._items.values())
+        self._items = {}
+        db_data = db.multi_get([key for item in items for key in table.get_index_keys(item[table.pk])])
         batch = {}
-        # 更新索引
-        for key, db_key in index_keys.items():
-            data = msgpack.unpackb(db.get(db_key))
-            if pkval in data:
-                data.pop(pkval, None)
-                batch[db_key] = msgpack.packb(data)
-        # 写入数据库
+        deleted = []
+        for item in items:
+            if table.cache is not None:
+                table.cache.invalidate(item[table.pk])
+                self._written.add(item[table.pk])
+            _batch, _deleted = table._prepare_save(item, db_data)
+            batch.update(_batch)
+            deleted.extend(_deleted)
+        batch.update(table._update_views({item[table.pk]: item for item in items}))
         db.multi_put(batch)
-        # 删除数据
-        meta_key = self.get_meta_key(pkval)
-        data_key = self.get_data_key(pkval)
-        db.delete(meta_key)
-        db.delete(data_key)
+        for db_key in deleted:
+            db.delete(db_key)
+        table._clear_cache()
+
+
+class View:
+    '''视图: 满足 q 的记录及其 fields 字段, 由 Table.save, Table.delete 维护'''
+    def __init__(self, table, name, q, fields=()):
+        self.table = table
+        self.name = name
+        self.q = q
+        self.fields = list(fields)
+        self.match = q.compile()
+        # Q 或字段涉及 heavy_keys 时需要完整的记录
+        heavy_keys = table.heavy_keys
+        keys = itertools.chain(q.keys(), self.fields)
+        self.shallow = not any((key.split('.')[0] in heavy_keys for key in keys))
+
+    def __str__(self):
+        return '<View #%s.%s q=%s fields=%s>' % (self.table.name, self.name, self.q, ','.join(self.fields))
+
+    def __repr__(self):
+        return self.__str__()
+
+    def definition(self):
+        return msgpack.packb([self.q.canonical(), self.fields])
+
+    def project(self, item):
+        return [get_key(item, field) for field in self.fields]
+
+
+class WriteBehind:
+    '''
+    后台写入: save() 把记录放入有界队列后立即返回, 写线程从队列中取出记录,
+    每 batch_size 条或每 interval 秒用 BulkWriter 在一个事务中写入, 同一主键只写入最后一次
+
+    flush() 等待已放入队列的记录全部写入, close() 写入剩余的记录后结束写线程,
+    进程退出时自动 close(); 写入出错后, 之后的 save(), flush(), close() 抛出该异常
+    记录放入队列后不要再修改
+    '''
+    def __init__(self, table, batch_size=500, interval=0.2, max_pending=5000, durable=True):
+        self.table = table
+        self.batch_size = batch_size
+        self.interval = interval
+        self.durable = durable
+        self.count = 0
+        self.batches = 0
+        self.error = None
+        self._queue = queue.Queue(max_pending)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='WriteBehind-%s' % table.name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __str__(self):
+        return '<WriteBehind #%s %d items %d batches>' % (self.table.name, self.count, self.batches)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def save(self, item):
+        table = self.table
+        if table.pk not in item or not isinstance(item[table.pk], str):
+            raise ValueError(self.__str__() + '.save(): primary key not valid')
+        if self._closed:
+            raise ValueError(self.__str__() + '.save(): closed')
+        self._check()
+        # 队列满时阻塞, 直到写线程取走记录
+        self._queue.put(item)
+
+    def flush(self):
+        if self._closed:
+            self._check()
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        self._check()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            atexit.unregister(self.close)
+        self._check()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        stop = False
+        while not stop:
+            # 等待第一条记录, 之后最多再等待 interval 秒
+            items = []
+            events = []
+            entry = self._queue.get()
+            deadline = time.monotonic() + self.interval
+            while True:
+                if entry is None:
+                    stop = True
+                elif isinstance(entry, threading.Event):
+                    events.append(entry)
+                else:
+                    items.append(entry)
+                if stop or events or len(items) >= self.batch_size:
+                    break
+                timeout = deadline - time.monotonic()
+                try:
+                    entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if items and self.error is None:
+                try:
+                    with self.table.bulk_writer(buffer_size=len(items), checkpoint=self.durable) as writer:
+                        for item in items:
+                            writer.save(item)
+                    self.count += len(items)
+                    self.batches += 1
+                except BaseException as e:
+                    self.error = e
+            for event in events:
+                event.set()
+        if not self.durable and self.error is None:
+            try:
+                self.table._db.checkpoint()
+            except BaseException as e:
+                self.error = e
+
+
+class RecordCache:
+    '''
+    解码后记录的 LRU 缓存, 按条数和近似字节数 (编码后的大小) 限制
+
+    读取前记下 generation, 写入缓存时 generation 已变化说明期间有记录被修改,
+    不写入缓存, 避免缓存旧数据; 修改记录时写入前后各 invalidate() 一次
+
+    get() 返回缓存中的记录本身, Table 返回它的浅拷贝, 嵌套的 dict, list 和序列与缓存共用,
+    调用者不能修改, 需要修改时先 copy.deepcopy()
+    '''
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return '<RecordCache %d items %d bytes>' % (len(self._data), self.bytes)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def get(self, key):
+        # 返回缓存中的记录本身, 调用者不能修改
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, item, size, generation):
+        with self._lock:
+            if generation != self.generation or size > self.max_bytes:
+                return
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (item, size)
+            self.bytes += size
+            while len(self._data) > self.max_items or self.bytes > self.max_bytes:
+                _, (_, _size) = self._data.popitem(last=False)
+                self.bytes -= _size
+
+    def invalidate(self, pkval):
+        with self._lock:
+            self.generation += 1
+            for shallow in (True, False):
+                old = self._data.pop((pkval, shallow), None)
+                if old is not None:
+                    self.bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self.bytes = 0
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'items': len(self._data),
+            'bytes': self.bytes,
+        }
 
 
 class QuerySet:
-    def __init__(self, table, q, shallow):
+    def __init__(self, table, q, shallow, order=(), offset=0, limit=None):
         self.table = table
         self.q = q
         self.shallow = shallow
+        self.order = tuple(order)
+        self.offset = offset
+        self.limit = limit
 
     def __str__(self):
-        return '<QuerySet %s q=%s>' % (self.table.name, self.q or '')
+        s = '<QuerySet %s q=%s' % (self.table.name, self.q or '')
+        if self.order:
+            s += ' order=%s' % ','.join(self.order)
+        if self.offset or self.limit is not None:
+            s += ' [%d:%s]' % (self.offset, '' if self.limit is None else self.offset + self.limit)
+        return s + '>'
 
     def __repr__(self):
         return self.__str__()
 
     def __iter__(self):
-        return self.table._filter(q=self.q, shallow=self.shallow)
+        return self._iter(self.shallow)
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            if key < 0:
+                raise IndexError(self.__str__() + '[]: negative index not supported')
+            for item in self[key:key + 1]:
+                return item
+            raise IndexError(self.__str__() + '[]: index out of range')
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError(self.__str__() + '[]: only int and slice without step are supported')
+        start = key.start or 0
+        if start < 0 or (key.stop is not None and key.stop < 0):
+            raise IndexError(self.__str__() + '[]: negative index not supported')
+        limit = None if key.stop is None else max(key.stop - start, 0)
+        if self.limit is not None:
+            remain = max(self.limit - start, 0)
+            limit = remain if limit is None else min(limit, remain)
+        return QuerySet(self.table, self.q, self.shallow, self.order, self.offset + start, limit)
+
+    def _iter(self, shallow):
+        table = self.table
+        if self.order:
+            return table._filter_ordered(self.q, shallow, self.order, self.offset, self.limit)
+        stop = None if self.limit is None else self.offset + self.limit
+        if self.q is None:
+            it = table._filter(shallow=shallow, limit=stop)
+        elif self._sliced():
+            # 有缓存的结果时只读取需要的记录
+            pkvals = table.get_query_cache(self.q, shallow)
+            if pkvals is not None:
+                return table._filter(self.q, shallow, pkvals[self.offset:stop])
+            it = table._filter(q=self.q, shallow=shallow, limit=stop)
+        else:
+            return table._filter_cached(self.q, shallow)
+        if self.offset or self.limit is not None:
+            it = itertools.islice(it, self.offset, stop)
+        return it
+
+    def _sliced(self):
+        return self.offset or self.limit is not None
+
+    def _pks(self):
+        # 只使用索引得到结果的主键, 需要读取记录时返回 None
+        table = self.table
+        stop = None if self.limit is None else self.offset + self.limit
+        if self.order:
+            result = table._order_pks(self.q, self.order, stop)
+            if result is None or not result[1]:
+                return None
+            pkvals = result[0]
+        else:
+            pkvals = table._filter_pks(None) if self.q is None else table._query_pks(self.q, self.shallow)
+            if pkvals is None:
+                return None
+        return pkvals[self.offset:stop]
 
     def filter(self, q=None, **kwargs):
+        if self._sliced():
+            raise ValueError(self.__str__() + '.filter(): cannot filter after slicing')
         if q is None and kwargs:
             q = Q.from_kwargs(kwargs)
         if q is None:
             q = self.q
-        else:
+        elif self.q is not None:
             q = self.q & q
-        return QuerySet(self.table, q=q, shallow=self.shallow)
+        return QuerySet(self.table, q=q, shallow=self.shallow, order=self.order)
+
+    def order_by(self, *fields):
+        '''按字段排序, '-' 开头表示降序, 缺失值排在最后'''
+        if self._sliced():
+            raise ValueError(self.__str__() + '.order_by(): cannot reorder after slicing')
+        return QuerySet(self.table, q=self.q, shallow=self.shallow, order=fields)
 
     def first(self):
-        try:
-            return next(self.__iter__())
-        except StopIteration:
-            return None
+        for item in self[:1]:
+            return item
+        return None
 
     def list(self):
         return list(self.__iter__())
 
+    def _covered(self, fields):
+        # 字段都是顶层的索引字段时, 只读取索引即可
+        index_keys = self.table.index_keys
+        return bool(fields) and all((field in index_keys and '.' not in field for field in fields))
+
     def list_field(self, field):
+        if self._covered([field]):
+            pkvals = self._pks()
+            if pkvals is not None:
+                return [i[0] for i in self.table.project(pkvals, [field])]
+        # 缺少的字段为 None, 与只读取索引时一致
         if field in self.table.heavy_keys:
-            it = self.table._filter(q=self.q, shallow=False)
-            return [i[field] for i in it]
+            it = self._iter(shallow=False)
+            return [i.get(field) for i in it]
         else:
-            it = self.table._filter(q=self.q, shallow=True)
-            return [i[field] for i in it]
+            it = self._iter(shallow=True)
+            return [i.get(field) for i in it]
 
     def list_fields(self, *fields):
+        if self._covered(fields):
+            pkvals = self._pks()
+            if pkvals is not None:
+                return self.table.project(pkvals, fields)
         if any((field in self.table.heavy_keys for field in fields)):
-            it = self.table._filter(q=self.q, shallow=False)
-            return [[i[field] for field in fields] for i in it]
+            it = self._iter(shallow=False)
+            return [[i.get(field) for field in fields] for i in it]
         else:
-            it = self.table._filter(q=self.q, shallow=True)
-            return[[i[field] for field in fields] for i in it]
+            it = self._iter(shallow=True)
+            return [[i.get(field) for field in fields] for i in it]
+
+    def parallel(self, workers=None, func=None, chunk_size=200):
+        '''
+        使用 workers 个进程读取并解码记录, 按顺序返回
+
+        func 不为 None 时在子进程中对每条记录调用 func, 返回 func 的结果; func 需要能被 pickle.
+        记录需要 pickle 后传回主进程, 返回完整的记录往往比单进程更慢, 应使用 func 只返回需要的部分
+        '''
+        table = self.table
+        if self.order or self._sliced():
+            pkvals = self._pks()
+            if pkvals is None:
+                raise ValueError(self.__str__() + '.parallel(): order_by() and slicing need indexed fields')
+            return table._iter_parallel(pkvals, None, None, self.shallow, workers, func, chunk_size)
+        pkvals, sure = table._candidates(self.q, shallow=self.shallow)
+        if not self.q:
+            sure = None
+        return table._iter_parallel(pkvals, sure, self.q, self.shallow, workers, func, chunk_size)
+
+    def delete(self):
+        '''删除满足条件的记录, 返回删除的条数'''
+        table = self.table
+        pkvals = self._pks()
+        if pkvals is None:
+            pkvals = self.list_field(table.pk)
+        return table.delete_many(pkvals)
 
     def count(self):
+        pkvals = self._pks()
+        if pkvals is not None:
+            return len(pkvals)
         pk = self.table.pk
         return len(self.list_field(pk))
 
+    def explain(self):
+        '''返回查询计划的文字描述'''
+        table = self.table
+        record_cost = COST_RECORD if self.shallow else COST_HEAVY_RECORD
+        kind = 'shallow' if self.shallow else 'full'
+        if not self.q:
+            rows = table.get_stats()['rows']
+            return '\n'.join([
+                self.__str__(),
+                'Fetch %s records  rows≈%d cost≈%d' % (kind, rows, rows * record_cost),
+            ])
+        plan = table.plan(self.q, shallow=self.shallow)
+        cost = plan.cost + plan.rows * record_cost
+        lines = [
+            self.__str__(),
+            'Fetch %s records  rows≈%d cost≈%d' % (kind, plan.rows, cost),
+        ]
+        lines.extend(plan.explain(depth=1))
+        return '\n'.join(lines)
+
+
+#
+# 查询计划
+#
+# 每个节点执行后返回 (sure, maybe) 两个主键集合: sure 中的记录一定满足条件,
+# maybe 之外的记录一定不满足条件, 其余的记录需要读取数据后逐条匹配.
+# 集合为 None 表示全表.
+#
+
+# 代价估计, 以读取一个有序索引项为单位
+COST_INDEX_KEY = 1
+COST_INDEX_VALUE = 2
+COST_COLUMN = 0.02
+COST_RECORD = 20
+COST_HEAVY_RECORD = 200
+
+
+class Plan:
+    name = ''
+
+    def __init__(self, table, q, rows, cost, children=None):
+        self.table = table
+        self.q = q
+        self.rows = rows
+        self.cost = cost
+        self.children = children or []
+
+    def __str__(self):
+        return '\n'.join(self.explain())
+
+    def __repr__(self):
+        return self.__str__()
+
+    def execute(self):
+        raise NotImplementedError()
+
+    def explain(self, depth=0):
+        indent = '  ' * depth
+        if self.children:
+            head = '%s%s  rows≈%d cost≈%d' % (indent, self.name, self.rows, self.cost)
+        else:
+            head = '%s%s %s  rows≈%d cost≈%d' % (indent, self.name, self.q, self.rows, self.cost)
+        lines = [head]
+        for child in self.children:
+            lines.extend(child.explain(depth + 1))
+        return lines
+
+
+class SeekPlan(Plan):
+    '''有序索引范围查找'''
+    name = 'IndexSeek'
+
+    def execute(self):
+        q = self.q
+        return self.table.seek_index(q.left, q.op, q.right)
+
+
+class GramSeekPlan(Plan):
+    '''字词索引查找候选, 再逐条匹配'''
+    name = 'GramSeek'
+
+    def execute(self):
+        q = self.q
+        return self.table.seek_grams(q.left, q.right)
+
+
+class ColumnScanPlan(Plan):
+    '''在索引列上向量化计算'''
+    name = 'ColumnScan'
+
+    def execute(self):
+        table = self.table
+        mask = table.eval_columns(self.q)
+        pkvals = set(table.get_column_pks()[mask].tolist())
+        return pkvals, pkvals
+
+
+class RecordScanPlan(Plan):
+    '''没有可用的索引, 读取记录后逐条匹配'''
+    name = 'Residual'
+
+    def execute(self):
+        return set(), None
+
+
+class NotPlan(Plan):
+    name = 'Not'
+
+    def execute(self):
+        sure, maybe = self.children[0].execute()
+        table = self.table
+        return table._complement(maybe), table._complement(sure)
+
+
+class AndPlan(Plan):
+    name = 'And'
+
+    def __init__(self, table, q, rows, cost, children, residual):
+        super().__init__(table, q, rows, cost, children)
+        self.residual = residual
+
+    def execute(self):
+        sure = None
+        maybe = None
+        for child in self.children:
+            _sure, _maybe = child.execute()
+            sure = _sure if sure is None else sure & _sure
+            if _maybe is not None:
+                maybe = _maybe if maybe is None else maybe & _maybe
+        if self.residual:
+            sure = set()
+        return sure, maybe
+
+    def explain(self, depth=0):
+        lines = super().explain(depth)
+        indent = '  ' * (depth + 1)
+        for plan in self.residual:
+            lines.append('%sResidual %s' % (indent, plan.q))
+        return lines
+
+
+class OrPlan(Plan):
+    name = 'Or'
+
+    def execute(self):
+        sure = set()
+        maybe = set()
+        for child in self.children:
+            _sure, _maybe = child.execute()
+            sure |= _sure
+            if maybe is not None:
+                maybe = None if _maybe is None else maybe | _maybe
+        return sure, maybe
+
+
+# _filter 预读使用的线程池, 各线程保留自己的只读连接; fork 出的子进程重新创建
+_read_ahead = {'pid': None, 'executor': None}
+_read_ahead_lock = threading.Lock()
+
+
+def _read_ahead_executor():
+    with _read_ahead_lock:
+        if _read_ahead['pid'] != os.getpid():
+            _read_ahead['executor'] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=READ_AHEAD_WORKERS, thread_name_prefix='read-ahead')
+            _read_ahead['pid'] = os.getpid()
+        return _read_ahead['executor']
+
+
+# 子进程中的只读 Table 和查询参数, 由 _parallel_init 设置
+_parallel_state = {}
+
+
+def _parallel_init(config, q, shallow, func):
+    db_uri, name, pk, indexes, heavy_keys, series_keys, backend = config
+    _parallel_state['table'] = Table(db_uri, name, pk, indexes, heavy_keys, series_keys, readonly=True,
+                                     backend=backend)
+    _parallel_state['match'] = q.compile() if q else None
+    _parallel_state['shallow'] = shallow
+    _parallel_state['func'] = func
+
+
+def _parallel_work(pkvals, sure):
+    table = _parallel_state['table']
+    match = _parallel_state['match']
+    func = _parallel_state['func']
+    result = []
+    for item in table.iter_bulk_get_by_pk(pkvals, shallow=_parallel_state['shallow']):
+        if sure is None or match is None or item[table.pk] in sure or match(item):
+            result.append(item if func is None else func(item))
+    return result
+
 
 def get_key(data, key):
     value = data
     for segment in key.split('.'):
-        if segment not in value:
+        # 中间的值不是 dict 时视为缺失
+        if not isinstance(value, dict) or segment not in value:
             return None
         value = value[segment]
     return value
@@ -360,16 +2857,348 @@ def put_key(data, key, value):
     node[segment] = value
 
 
-def _pack_datetime(item):
-    for key, value in item.items():
-        if isinstance(value, datetime.datetime):
-            item[key] = {
-                '__datetime__': True,
-                'timestamp': value.timestamp() * 1000,
-            }
+class Column:
+    '''
+    按主键顺序排列的一个索引字段
+
+    数值和字符串字段保存为 NumPy 数组, 可以向量化计算比较运算;
+    其它类型 (list, dict 等) 只保存原始值, 由调用者逐条匹配
+    '''
+    def __init__(self, field, values):
+        self.field = field
+        self.values = values
+        self.present = np.array([i is not None for i in values], dtype=bool)
+        types = {type(i) for i in values if i is not None}
+        if types <= {bool, int, float} and all((_is_number(i) for i in values if i is not None)):
+            self.kind = 'number'
+            self.array = np.array([np.nan if i is None else float(i) for i in values], dtype=np.float64)
+        elif types <= {str}:
+            self.kind = 'string'
+            self.array = np.array(['' if i is None else i for i in values], dtype=str)
+        else:
+            self.kind = 'object'
+            self.array = None
+        self._lower = None
+
+    def __str__(self):
+        return '<Column %s %s>' % (self.field, self.kind)
+
+    def __repr__(self):
+        return self.__str__()
+
+    @property
+    def lower(self):
+        if self._lower is None:
+            self._lower = np.char.lower(self.array)
+        return self._lower
+
+    def mask(self, op, right):
+        # 无法向量化时返回 None
+        present = self.present
+        if op == '$e':
+            return present.copy()
+        elif op == '$ne':
+            return ~present
+        array = self.array
+        kind = self.kind
+        if kind == 'number':
+            right_type = _is_number(right)
+        elif kind == 'string':
+            right_type = isinstance(right, str)
+        else:
+            return None
+        if op in _NP_COMPARE_OPS and right_type:
+            result = _NP_COMPARE_OPS[op](array, right)
+        elif op in ['==', '===', '!=']:
+            # 类型不同的值一定不相等
+            result = np.full(len(array), op == '!=', dtype=bool)
+        elif op == '$in' and isinstance(right, (list, tuple, set)):
+            if kind == 'number':
+                result = np.isin(array, [float(i) for i in right if _is_number(i)])
+            else:
+                result = np.isin(array, [i for i in right if isinstance(i, str)])
+        elif op in ['$true', '$false']:
+            if kind == 'number':
+                result = array != 0
+            else:
+                result = np.char.str_len(array) > 0
+            if op == '$false':
+                result = ~result
+        elif op in ['~', '!~'] and kind == 'string' and right_type:
+            result = np.char.find(self.lower, right.lower()) >= 0
+            if op == '!~':
+                result = ~result
+        else:
+            return None
+        missing = op not in ['===', '$true', '$false']
+        return np.where(present, result, missing)
+
+
+_NP_COMPARE_OPS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '===': np.equal,
+    '!=': np.not_equal,
+}
+
+
+def _is_number(value):
+    if isinstance(value, int):
+        return abs(value) <= 1 << 53
+    return isinstance(value, float)
+
+
+def _to_series(value):
+    # [[ts, value, change], ...] 转为 SERIES_DTYPE 数组, 无法转换时返回原值
+    if isinstance(value, np.ndarray):
+        if value.dtype == SERIES_DTYPE:
+            return value
+        value = value.tolist()
+    if not value or not isinstance(value, list):
+        return value
+    try:
+        return np.array([tuple(i) for i in value], dtype=SERIES_DTYPE)
+    except (TypeError, ValueError):
+        return value
+
+
+def _split_series(series):
+    # 按年 (UTC) 分块, 返回 {year: array}; 无法分块时返回 None
+    if not isinstance(series, np.ndarray) or not len(series):
+        return None
+    ts = series['ts']
+    if np.any(ts[1:] < ts[:-1]):
+        return None
+    years = ts.astype('datetime64[ms]').astype('datetime64[Y]').astype(np.int64) + 1970
+    bounds = np.flatnonzero(years[1:] != years[:-1]) + 1
+    starts = [0] + bounds.tolist()
+    ends = bounds.tolist() + [len(series)]
+    return {int(years[i]): series[i:j] for i, j in zip(starts, ends)}
+
+
+def _series_header(data):
+    '''解析 d2_{pk}\x00{field}, 返回 (年份列表, 分块是否压缩)'''
+    header = msgpack.unpackb(data)
+    if isinstance(header, dict):
+        return header['years'], header['compressed']
+    return header, False
+
+
+def _concat_series(chunks):
+    arrays = [np.frombuffer(i, dtype=SERIES_DTYPE) for i in chunks]
+    if len(arrays) == 1:
+        return arrays[0]
+    if not arrays:
+        return np.empty(0, dtype=SERIES_DTYPE)
+    return np.concatenate(arrays)
+
+
+def _msts_year(msts):
+    return datetime.datetime.fromtimestamp(msts / 1000, datetime.timezone.utc).year
+
+
+def _to_msts(day):
+    if day is None or isinstance(day, (int, float)):
+        return day
+    return day2msts(day)
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, np.ndarray) and obj.dtype == SERIES_DTYPE:
+        return msgpack.ExtType(EXT_SERIES, obj.tobytes())
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, msgpack.Timestamp.from_unix(obj.timestamp()).to_bytes())
+    raise TypeError('can not serialize %r' % type(obj))
+
+
+def _msgpack_ext_hook(code, data):
+    if code == EXT_SERIES:
+        return np.frombuffer(data, dtype=SERIES_DTYPE)
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromtimestamp(msgpack.Timestamp.from_bytes(data).to_unix())
+    return msgpack.ExtType(code, data)
+
+
+def _ngrams(value):
+    '''字符串 (小写) 或字符串列表中各字符串的单字和二元组'''
+    if isinstance(value, str):
+        value = [value]
+    elif not isinstance(value, list):
+        return set()
+    grams = set()
+    for text in value:
+        if not isinstance(text, str):
+            continue
+        text = text.lower()
+        grams.update(text)
+        grams.update((text[i:i + 2] for i in range(len(text) - 1)))
+    return grams
+
+
+def _codec_available(name):
+    if name == 'lz4':
+        return lz4_block is not None
+    if name == 'zstd':
+        return zstandard is not None
+    return name in CODECS
+
+
+def _compress(name, data, level=None, zdict=None):
+    if name == 'zlib':
+        level = -1 if level is None else level
+        if zdict is None:
+            return zlib.compress(data, level)
+        compressor = zlib.compressobj(level, zdict=zdict)
+        return compressor.compress(data) + compressor.flush()
+    if name == 'lz4':
+        kwargs = {} if zdict is None else {'dict': zdict}
+        if level:
+            kwargs.update(mode='high_compression', compression=level)
+        return lz4_block.compress(data, **kwargs)
+    kwargs = {} if zdict is None else {'dict_data': _zstd_dict(zdict)}
+    return zstandard.ZstdCompressor(level=3 if level is None else level, **kwargs).compress(data)
+
+
+def _decompress(name, data, zdict=None):
+    if name == 'zlib':
+        if zdict is None:
+            return zlib.decompress(data)
+        decompressor = zlib.decompressobj(zdict=zdict)
+        return decompressor.decompress(data) + decompressor.flush()
+    if name == 'lz4':
+        kwargs = {} if zdict is None else {'dict': zdict}
+        return lz4_block.decompress(data, **kwargs)
+    kwargs = {} if zdict is None else {'dict_data': _zstd_dict(zdict)}
+    return zstandard.ZstdDecompressor(**kwargs).decompress(data)
+
+
+@functools.lru_cache(maxsize=8)
+def _zstd_dict(zdict):
+    return zstandard.ZstdCompressionDict(zdict)
+
+
+def _train_dictionary(name, samples, dict_size):
+    if name == 'zstd':
+        return zstandard.train_dictionary(dict_size, samples).as_bytes()
+    # zlib, lz4 没有训练方法, 使用样本拼接后的结尾部分, 越靠近结尾的内容越容易被引用
+    size = min(dict_size, 32 * 1024) if name == 'zlib' else dict_size
+    return b''.join(samples)[-size:]
+
+
+def _packb(obj):
+    return msgpack.packb(obj, default=_msgpack_default)
+
+
+def _unpackb(data):
+    obj = msgpack.unpackb(data, ext_hook=_msgpack_ext_hook)
+    # 旧格式: 顶层字段中的 datetime 保存为 {'__datetime__': True, 'timestamp': ms}
+    if b'__datetime__' in data and isinstance(obj, dict):
+        if '__datetime__' in obj:
+            return _unpack_datetime_value(obj)
+        _unpack_datetime(obj)
+    return obj
+
+
+def _parse_order(order):
+    # ['-aror.1y', 'mdd.2020'] -> [('aror.1y', True), ('mdd.2020', False)]
+    return [(field[1:], True) if field.startswith('-') else (field, False) for field in order]
+
+
+class _Desc:
+    '''降序排列的排序键'''
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def _order_key(values, order, pkval):
+    '''
+    排序键, 与有序索引的顺序一致: 数字 < 字符串 < 其他值 (其他值之间视为相等),
+    缺失值不论升序降序都排在最后, 值相同时按主键升序
+    '''
+    key = []
+    for value, (_, reverse) in zip(values, order):
+        sortable = _encode_sortable(value)
+        if sortable == _SORT_NULL:
+            key.append((1, None))
+        elif reverse:
+            key.append((0, _Desc(sortable)))
+        else:
+            key.append((0, sortable))
+    key.append(pkval)
+    return key
+
+
+def _flatten_q(q, op):
+    # 展开连续的 & 或 |
+    if q.complex and q.complex[0] == op:
+        return _flatten_q(q.complex[1], op) + _flatten_q(q.complex[2], op)
+    return [q]
+
+
+def _histogram(values, distinct):
+    # values 已经有序
+    n = len(values)
+    if not n:
+        return {'n': 0, 'distinct': 0, 'bounds': []}
+    bounds = [values[i * (n - 1) // STATS_BUCKETS] for i in range(STATS_BUCKETS + 1)]
+    return {'n': n, 'distinct': distinct, 'bounds': bounds}
+
+
+def _encode_sortable(value):
+    # 编码后的字节序与值的大小顺序一致
+    if value is None:
+        return _SORT_NULL
+    if isinstance(value, (bool, int, float)):
+        # float 无法精确表示的整数不参与排序
+        if isinstance(value, int) and abs(value) > 1 << 53:
+            return _SORT_OTHER
+        value = float(value) + 0.0
+        if value != value:
+            return _SORT_OTHER
+        bits, = struct.unpack('>Q', struct.pack('>d', value))
+        if bits >> 63:
+            bits ^= 0xFFFFFFFFFFFFFFFF
+        else:
+            bits |= 1 << 63
+        return _SORT_NUMBER + struct.pack('>Q', bits)
+    if isinstance(value, str):
+        if '\x00' in value:
+            return _SORT_OTHER
+        return _SORT_STRING + value.encode('utf8')
+    return _SORT_OTHER
+
+
+def _decode_sortable(data):
+    tag = data[:1]
+    if tag == _SORT_NUMBER:
+        bits, = struct.unpack('>Q', data[1:9])
+        if bits >> 63:
+            bits ^= 1 << 63
+        else:
+            bits ^= 0xFFFFFFFFFFFFFFFF
+        return struct.unpack('>d', struct.pack('>Q', bits))[0]
+    if tag == _SORT_STRING:
+        return data[1:].decode('utf8')
+    return None
 
 
 def _unpack_datetime(item):
     for key, value in item.items():
-        if isinstance(value, dict) and '__datetime__' in value:
-            item[key] = datetime.datetime.fromtimestamp(value['timestamp'] / 1000)
+        item[key] = _unpack_datetime_value(value)
+
+
+def _unpack_datetime_value(value):
+    if isinstance(value, dict) and '__datetime__' in value:
+        return datetime.datetime.fromtimestamp(value['timestamp'] / 1000)
+    return value
@@ -3,6 +3,7 @@
 # Copyright (C) 2020 - , puxxustc
 
 
+import operator
 import re
 
 from lib_util import get_key
@@ -16,6 +17,7 @@ __all__ = [
 class Q():
     '''query'''
     def __init__(self, *args):
+        self._compiled = {}
         if not args:
             self.op = '#EMPTY#'
             self.left = None
@@ -166,6 +168,36 @@ class Q():
         else:
             return [self.left]
 
+    def canonical(self):
+        '''
+        规范化的字符串, 结果相同的 Q 尽量得到相同的字符串, 用于缓存查询结果:
+        连续的 & (|) 展开后排序并去重, 两次取反抵消, $in 的列表排序
+        '''
+        if self.op == '#EMPTY#':
+            return 'Q()'
+        elif self.complex and self.complex[0] == '~':
+            q1 = self.complex[1]
+            if q1.complex and q1.complex[0] == '~':
+                return q1.complex[1].canonical()
+            return '~(%s)' % q1.canonical()
+        elif self.complex:
+            op = self.complex[0]
+            items = set()
+            stack = [self]
+            while stack:
+                q = stack.pop()
+                if q.complex and q.complex[0] == op:
+                    stack.extend(q.complex[1:])
+                else:
+                    items.add(q.canonical())
+            if len(items) == 1:
+                return items.pop()
+            return '(%s)' % (' %s ' % op).join(sorted(items))
+        right = self.right
+        if self.op == '$in' and isinstance(right, (list, tuple, set)):
+            right = sorted(right, key=repr)
+        return '%s %s %r' % (self.left, self.op, right)
+
     def match(self, data, none_as_match=True, shallow_match=False):
         if self.op == '#EMPTY#':
             return True
@@ -256,6 +288,86 @@ class Q():
                 match = left is not None and not bool(left)
             return match
 
+    def __getstate__(self):
+        # 编译得到的函数无法 pickle, 在 unpickle 后重新编译
+        state = dict(self.__dict__)
+        state['_compiled'] = {}
+        return state
+
+    def compile(self, none_as_match=True, shallow_match=False):
+        '''编译为函数 func(data), 结果与 match() 相同'''
+        key = (none_as_match, shallow_match)
+        if key not in self._compiled:
+            self._compiled[key] = self._compile(none_as_match, shallow_match)
+        return self._compiled[key]
+
+    def _compile(self, none_as_match, shallow_match):
+        if self.op == '#EMPTY#':
+            return _always_true
+        elif self.complex and self.complex[0] == '~':
+            func = self.complex[1]._compile(none_as_match, shallow_match)
+            return lambda data: not func(data)
+        elif self.complex and self.complex[0] in ['&', '|']:
+            op = self.complex[0]
+            func1 = self.complex[1]._compile(none_as_match, shallow_match)
+            func2 = self.complex[2]._compile(none_as_match, shallow_match)
+            if op == '&':
+                return lambda data: func2(data) if func1(data) else False
+            else:
+                return lambda data: True if func1(data) else func2(data)
+
+        op = self.op
+        right = self.right
+        if op in ['===', '==']:
+            def test(left):
+                return left == right
+        elif op == '!=':
+            def test(left):
+                return left != right
+        elif op in _COMPARE_OPS:
+            test = _compile_compare(_COMPARE_OPS[op], right)
+        elif op in ['~', '!~']:
+            test = _compile_contains(right, negate=(op == '!~'))
+        elif op == '$in':
+            def test(left):
+                return left in right
+        elif op == '$e':
+            test = _always_true
+        elif op == '$ne':
+            test = _always_false
+        elif op == '$true':
+            test = bool
+        elif op == '$false':
+            test = operator.not_
+        else:
+            test = _always_false
+
+        if not shallow_match and op in ['===', '$e', '$true', '$false']:
+            missing = False
+        else:
+            missing = none_as_match
+
+        segments = self.left.split('.')
+        if len(segments) == 1:
+            segment = segments[0]
+
+            def func(data):
+                left = data.get(segment)
+                if left is None:
+                    return missing
+                return test(left)
+        else:
+            def func(data):
+                left = data
+                for segment in segments:
+                    if not isinstance(left, dict) or segment not in left:
+                        return missing
+                    left = left[segment]
+                if left is None:
+                    return missing
+                return test(left)
+        return func
+
     @classmethod
     def from_kwargs(cls, kwargs):
         r = None
@@ -272,6 +384,53 @@ class Q():
         return cls.from_kwargs(kwargs)
 
 
+_COMPARE_OPS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+_SCALAR_TYPES = frozenset([int, float, str])
+
+
+def _always_true(data):
+    return True
+
+
+def _always_false(data):
+    return False
+
+
+def _compile_compare(cmp, right):
+    # list, dict 要求所有元素都满足条件
+    def test(left):
+        if left.__class__ in _SCALAR_TYPES:
+            return cmp(left, right)
+        if isinstance(left, list):
+            return left and all((cmp(i, right) for i in left))
+        elif isinstance(left, dict):
+            return left and all((cmp(i, right) for i in left.values()))
+        return cmp(left, right)
+    return test
+
+
+def _compile_contains(right, negate):
+    # 字段值为 str 时要求 right 也是 str, 字段值为 list 时 right 可以是任意类型, 只能在匹配时检查
+    lower = right.lower() if isinstance(right, str) else None
+
+    def test(left):
+        if isinstance(left, str):
+            if lower is None:
+                raise TypeError('Q(): %s operand must be str, not %s' % ('!~' if negate else '~', type(right).__name__))
+            return (lower in left.lower()) != negate
+        elif isinstance(left, list):
+            return (right in left) != negate
+        return False
+    return test
+
+
 class F():
     def __init__(self, key=None):
         self.key = key
@@ -286,6 +445,12 @@ class F():
         else:
             raise AttributeError("type object 'F' has no attribute '%s'" % attr)
 
+    def __getitem__(self, key):
+        # 嵌套的字段: F.aror['1y'] 即 F('aror.1y')
+        if not self.key:
+            return F(key)
+        return F('%s.%s' % (self.key, key))
+
     def __str__(self):
         if self.key:
             return 'F.%s' % self.key
@@ -346,6 +511,7 @@ def parse_filter(filter):
         for item in filter.split(','):
             item = item.strip()
             q = q & Q(item)
+        q.compile()
         return q
     except ValueError:
         raise ValueError('过滤器错误: 过滤器 "%s" 格式错误' % filter)
@@ -42,4 +42,7 @@ Fund = Table(
     'code',
     INDEXES,
     ['raw', 'navs', 'adjnavs', '7d_aror'],
+    ['navs', 'adjnavs'],
+    compression='zlib',
+    ngram_indexes=['name', 'fullname', 'managers'],
 )
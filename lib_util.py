@@ -24,7 +24,8 @@ def has_key(data, key):
 def get_key(data, key):
     value = data
     for segment in key.split('.'):
-        if segment not in value:
+        # 中间的值不是 dict 时视为缺失
+        if not isinstance(value, dict) or segment not in value:
             return None
         value = value[segment]
     return value
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (C) 2020 - , puxxustc
+
+'''
+lib_dbs 测试
+
+    python -m pytest test_dbs.py
+'''
+
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+import msgpack
+
+from lib_dbs import BACKENDS, INDEX_VERSION_KEY, STATS_KEY, Table, _series_header
+from lib_filter import parse_filter
+
+
+class TestNestedTransaction(unittest.TestCase):
+    '''各个存储后端的嵌套事务'''
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def open_dbs(self):
+        for name, wrapper in BACKENDS.items():
+            db = wrapper(os.path.join(self.path, name + '.db'))
+            db.put(b'k', b'v0')
+            yield name, db
+
+    def test_rollback_rollback(self):
+        for name, db in self.open_dbs():
+            db.begin()
+            db.begin()
+            db.put(b'k', b'v1')
+            db.put(b'n', b'v1')
+            db.rollback()
+            db.rollback()
+            self.assertEqual(db.get(b'k'), b'v0', name)
+            self.assertIsNone(db.get(b'n'), name)
+            self.assertFalse(db.in_transaction(), name)
+
+    def test_inner_rollback(self):
+        for name, db in self.open_dbs():
+            db.begin()
+            db.put(b'k', b'v1')
+            db.begin()
+            db.put(b'k', b'v2')
+            db.put(b'n', b'v2')
+            db.rollback()
+            self.assertEqual(db.get(b'k'), b'v1', name)
+            self.assertIsNone(db.get(b'n'), name)
+            db.commit()
+            self.assertEqual(db.get(b'k'), b'v1', name)
+            self.assertIsNone(db.get(b'n'), name)
+
+    def test_commit_rollback(self):
+        for name, db in self.open_dbs():
+            db.begin()
+            db.begin()
+            db.put(b'k', b'v1')
+            db.put(b'n', b'v1')
+            db.commit()
+            db.rollback()
+            self.assertEqual(db.get(b'k'), b'v0', name)
+            self.assertIsNone(db.get(b'n'), name)
+
+    def test_commit_commit(self):
+        for name, db in self.open_dbs():
+            db.begin()
+            db.put(b'k', b'v1')
+            db.begin()
+            db.put(b'n', b'v2')
+            db.delete(b'k')
+            db.commit()
+            db.commit()
+            self.assertIsNone(db.get(b'k'), name)
+            self.assertEqual(db.get(b'n'), b'v2', name)
+            self.assertEqual(db.scan_keys(), [b'n'], name)
+
+
+class TestOrder(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_order_by_nested_field(self):
+        # 排序字段比索引字段更深, 从索引值中读取剩余的路径
+        table = Table(os.path.join(self.path, 'test.ldb'), 'Test', 'code', ['a.b'], [])
+        rng = random.Random(1)
+        items = [{'code': '%03d' % i, 'a': {'b': {'c': rng.random()}}} for i in range(100)]
+        for item in items:
+            table.save(item)
+        expected = [item['code'] for item in sorted(items, key=lambda item: item['a']['b']['c'])]
+        self.assertEqual([item['code'] for item in table.filter().order_by('a.b.c')[:10]], expected[:10])
+        self.assertEqual([item['code'] for item in table.filter().order_by('-a.b.c')], expected[::-1])
+
+
+class TestFirst(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_first_reads_one_record(self):
+        table = Table(os.path.join(self.path, 'test.ldb'), 'Test', 'code', ['days'], [])
+        table.bulk_save(({'code': '%03d' % i, 'days': i, 'name': 'x%d' % (i % 3)} for i in range(500)))
+        fetched = []
+        fetch_records = table._fetch_records
+        table._fetch_records = lambda pkvals, shallow: fetched.append(len(pkvals)) or fetch_records(pkvals, shallow)
+        self.assertEqual(table.filter().first()['code'], '000')
+        self.assertEqual(table.filter(parse_filter('days > 10')).first()['code'], '011')
+        self.assertEqual(sum(fetched), 2)
+        # name 没有索引, 第一条不满足时继续读取
+        self.assertEqual(table.filter(parse_filter('name == "x2"')).first()['code'], '002')
+        self.assertEqual(table.filter(parse_filter('name == "x2"'))[1:3].list_field('code'), ['005', '008'])
+
+
+class TestListField(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_missing_field(self):
+        # 缺少的字段为 None, 与字段是否有索引无关
+        table = Table(os.path.join(self.path, 'test.ldb'), 'Test', 'code', ['days'], ['navs'])
+        table.save({'code': '000', 'days': 1, 'name': 'a', 'navs': [1]})
+        table.save({'code': '001'})
+        self.assertEqual(table.list_field('days'), [1, None])
+        self.assertEqual(table.list_field('name'), ['a', None])
+        self.assertEqual(table.list_field('navs'), [[1], None])
+        self.assertEqual(table.list_fields('days', 'name'), [[1, 'a'], [None, None]])
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_readonly_filter(self):
+        # 查询时自动统计只保存在内存中, 只读打开也可以查询
+        db_uri = os.path.join(self.path, 'test.ldb')
+        table = Table(db_uri, 'Test', 'code', ['days'], [])
+        for i in range(300):
+            table.save({'code': '%03d' % i, 'days': i * 10})
+        table._db.delete(STATS_KEY)
+        readonly = Table(db_uri, 'Test', 'code', ['days'], [], readonly=True)
+        self.assertEqual(readonly.filter(parse_filter('days > 1000')).count(), 199)
+        self.assertIsNone(readonly._db.get(STATS_KEY))
+        table.analyze()
+        self.assertIsNotNone(table._db.get(STATS_KEY))
+
+    def test_stale_stats(self):
+        # 新建表时保存的统计信息 rows=0, 其他进程写入后重新打开时按记录数判断过时
+        db_uri = os.path.join(self.path, 'test.ldb')
+        table = Table(db_uri, 'Test', 'code', ['days'], [])
+        for i in range(300):
+            table.save({'code': '%03d' % i, 'days': i * 10})
+        reopened = Table(db_uri, 'Test', 'code', ['days'], [])
+        self.assertEqual(reopened.get_stats()['rows'], 300)
+
+    def test_bulk_writer_saves_stats(self):
+        db_uri = os.path.join(self.path, 'test.ldb')
+        table = Table(db_uri, 'Test', 'code', ['days'], [])
+        table.bulk_save(({'code': '%03d' % i, 'days': i * 10} for i in range(300)))
+        self.assertEqual(msgpack.unpackb(table._db.get(STATS_KEY))['rows'], 300)
+
+
+class TestIndexVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_readonly_outdated(self):
+        # 只读打开旧格式的索引时报错, 读写打开时迁移
+        db_uri = os.path.join(self.path, 'test.ldb')
+        table = Table(db_uri, 'Test', 'code', ['days'], [])
+        for i in range(50):
+            table.save({'code': '%03d' % i, 'days': i})
+        table._db.put(INDEX_VERSION_KEY, b'3')
+        with self.assertRaises(ValueError):
+            Table(db_uri, 'Test', 'code', ['days'], [], readonly=True)
+        self.assertEqual(len(Table(db_uri, 'Test', 'code', ['days'], []).list_pk()), 50)
+        self.assertEqual(len(Table(db_uri, 'Test', 'code', ['days'], [], readonly=True).list_pk()), 50)
+
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_series(self):
+        # 压缩的序列分块, 以及 recompress() 后读取的序列不变
+        table = Table(os.path.join(self.path, 'test.ldb'), 'Test', 'code', [], ['navs'], ['navs'], compression='zlib')
+        day = 86400 * 1000
+        navs = [[1577836800000 + i * day, 1 + i / 1000, 0.001] for i in range(800)]
+        table.save({'code': '000', 'navs': navs})
+        for compression in ('zlib', None, 'zlib'):
+            table.compression = compression
+            table.recompress()
+            table._clear_cache()
+            header = table._db.get(table.get_series_key('000', 'navs'))
+            self.assertEqual(_series_header(header)[1], compression is not None)
+            self.assertEqual(table.get_by_pk('000')['navs'].tolist(), [tuple(i) for i in navs])
+            series = table.get_series('000', 'navs', navs[400][0], navs[500][0])
+            self.assertEqual(series.tolist(), [tuple(i) for i in navs[400:501]])
+        report = table.compression_report()
+        self.assertEqual({row['data'] for row in report}, {'d1_', 'd2_'})
+
+
+class TestBulkWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.table = Table(os.path.join(self.path, 'test.ldb'), 'Test', 'code', ['days'], [])
+        self.table.save({'code': '000', 'days': 0})
+        self.autocheckpoint = self.get_autocheckpoint()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def assert_released(self):
+        # 事务和写锁已释放, 其他线程可以写入
+        db = self.table._db
+        self.assertFalse(db.in_transaction())
+        thread = threading.Thread(target=self.table.save, args=({'code': '999', 'days': 9},))
+        thread.start()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.get_autocheckpoint(), self.autocheckpoint)
+
+    def get_autocheckpoint(self):
+        db = self.table._db
+        size = db.set_autocheckpoint(0)
+        db.set_autocheckpoint(size)
+        return size
+
+    def test_commit(self):
+        with self.table.bulk_writer(buffer_size=3) as writer:
+            for i in range(1, 10):
+                writer.save({'code': '%03d' % i, 'days': i})
+        self.assertEqual(self.table.list_pk(), ['%03d' % i for i in range(10)])
+        self.assert_released()
+
+    def test_exception_inside(self):
+        with self.assertRaises(RuntimeError):
+            with self.table.bulk_writer(buffer_size=3) as writer:
+                for i in range(1, 10):
+                    writer.save({'code': '%03d' % i, 'days': i})
+                raise RuntimeError()
+        self.assertEqual(self.table.list_pk(), ['000'])
+        self.assert_released()
+
+    def test_exception_in_last_flush(self):
+        # 最后一次 flush 出错时回滚并释放写锁
+        with self.assertRaises(TypeError):
+            with self.table.bulk_writer() as writer:
+                writer.save({'code': '001', 'days': 1})
+                writer.save({'code': '002', 'days': 2, 'name': object()})
+        self.assertEqual(self.table.list_pk(), ['000'])
+        self.assert_released()
+
+    def test_concurrent_autocheckpoint(self):
+        # 多个线程同时批量写入后恢复原来的 autocheckpoint
+        def run(n):
+            for i in range(20):
+                self.table.bulk_save(({'code': '%d%02d' % (n, j), 'days': j} for j in range(5)))
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(1, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.table.list_pk()), 16)
+        self.assert_released()
+
+
+class TestDelete(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.table = Table(os.path.join(self.path, 'test.ldb'), 'Test', 'code', ['days'], ['navs'], ['navs'])
+        navs = [[1577836800000, 1.0, 0.0], [1609459200000, 1.1, 0.1]]
+        self.table.bulk_save(({'code': '%03d' % i, 'days': i, 'navs': navs} for i in range(10)))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_delete_many(self):
+        self.assertEqual(self.table.delete_many(['001', '003', '005']), 3)
+        self.assertEqual(self.table.list_pk(), ['000', '002', '004', '006', '007', '008', '009'])
+        self.assertEqual(self.table.filter(parse_filter('days < 5')).list_field('code'), ['000', '002', '004'])
+        self.assertIsNone(self.table.get_by_pk('003'))
+        self.assertEqual(self.table._db.scan_keys(b'd2_003'), [])
+
+    def test_rollback(self):
+        # 删除过程中出错时回滚, 记录和索引都不变
+        def fail(changes):
+            raise RuntimeError()
+        self.table._update_views = fail
+        with self.assertRaises(RuntimeError):
+            self.table.delete_many(['001', '003'])
+        self.assertFalse(self.table._db.in_transaction())
+        self.assertEqual(len(self.table.list_pk()), 10)
+        self.assertEqual(self.table.filter(parse_filter('days < 5')).count(), 5)
+        self.assertEqual(len(self.table.get_by_pk('003')['navs']), 2)
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.table = Table(os.path.join(self.path, 'test.ldb'), 'Test', 'code', ['days'], [])
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_flush_close(self):
+        writer = self.table.write_behind(batch_size=7, interval=10)
+        for i in range(20):
+            writer.save({'code': '%03d' % i, 'days': i})
+        writer.flush()
+        self.assertEqual(len(self.table.list_pk()), 20)
+        writer.save({'code': '020', 'days': 20})
+        writer.close()
+        self.assertEqual(len(self.table.list_pk()), 21)
+        with self.assertRaises(ValueError):
+            writer.save({'code': '021', 'days': 21})
+
+    def test_error(self):
+        # 写入出错后, 之后的 save(), flush(), close() 抛出该异常, 出错的一批回滚
+        writer = self.table.write_behind(interval=10)
+        writer.save({'code': '000', 'days': 0})
+        writer.save({'code': '001', 'name': object()})
+        with self.assertRaises(TypeError):
+            writer.flush()
+        with self.assertRaises(TypeError):
+            writer.save({'code': '002', 'days': 2})
+        with self.assertRaises(TypeError):
+            writer.close()
+        self.assertEqual(self.table.list_pk(), [])
+        self.assertFalse(self.table._db.in_transaction())
+        self.table.save({'code': '003', 'days': 3})
+        self.assertEqual(self.table.list_pk(), ['003'])
+
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_uri = os.path.join(self.path, 'test.ldb')
+        self.table = Table(self.db_uri, 'Test', 'code', ['days'], [], persist_queries=True)
+        for i in range(20):
+            self.table.save({'code': '%03d' % i, 'days': i, 'name': 'x%d' % (i % 2)})
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_invalidate(self):
+        q = parse_filter('name == "x1", days > 10')
+        self.assertEqual(self.table.filter(q).list_field('code'), ['011', '013', '015', '017', '019'])
+        self.assertEqual(self.table.get_query_cache(q), ['011', '013', '015', '017', '019'])
+        # 写入后缓存失效
+        self.table.save({'code': '012', 'days': 12, 'name': 'x1'})
+        self.assertIsNone(self.table.get_query_cache(q))
+        self.assertEqual(self.table.filter(q).list_field('code'), ['011', '012', '013', '015', '017', '019'])
+
+    def test_persisted(self):
+        # 保存在数据库中的结果供之后打开的表使用, 其他表写入后失效
+        q = parse_filter('name == "x1"')
+        expected = self.table.filter(q).list_field('code')
+        reopened = Table(self.db_uri, 'Test', 'code', ['days'], [], persist_queries=True)
+        self.assertEqual(reopened.get_query_cache(q), expected)
+        reopened.delete('001')
+        self.assertIsNone(self.table.get_query_cache(q))
+        self.assertEqual(self.table.filter(q).list_field('code'), expected[1:])
+
+
+class TestViews(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_uri = os.path.join(self.path, 'test.ldb')
+        self.table = Table(self.db_uri, 'Test', 'code', ['days'], [])
+        for i in range(10):
+            self.table.save({'code': '%03d' % i, 'days': i, 'name': 'x%d' % i})
+        self.q = parse_filter('days >= 5')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def codes(self, name='big', table=None):
+        return [row['code'] for row in (table or self.table).get_view(name)]
+
+    def test_maintained(self):
+        self.table.create_view('big', self.q, ['name'])
+        self.assertEqual(self.codes(), ['005', '006', '007', '008', '009'])
+        self.assertEqual(self.table.get_view('big')[0], {'code': '005', 'name': 'x5'})
+        # 进入, 离开视图, 更新字段
+        self.table.save({'code': '001', 'days': 11, 'name': 'y1'})
+        self.table.save({'code': '006', 'days': 1, 'name': 'y6'})
+        self.table.save({'code': '007', 'days': 7, 'name': 'y7'})
+        self.assertEqual(self.codes(), ['001', '005', '007', '008', '009'])
+        self.assertEqual(self.table.get_view('big')[2], {'code': '007', 'name': 'y7'})
+        self.table.delete_many(['005', '000'])
+        self.assertEqual(self.codes(), ['001', '007', '008', '009'])
+        with self.table.bulk_writer() as writer:
+            writer.save({'code': '010', 'days': 10, 'name': 'x10'})
+            writer.save({'code': '008', 'days': 0, 'name': 'x8'})
+        self.assertEqual(self.codes(), ['001', '007', '009', '010'])
+        self.assertEqual(self.codes(), self.table.filter(self.q).list_field('code'))
+
+    def test_reopen(self):
+        # 定义相同时使用保存的视图, 定义改变时重建
+        self.table.create_view('big', self.q, ['name'])
+        self.table.save({'code': '001', 'days': 11})
+        reopened = Table(self.db_uri, 'Test', 'code', ['days'], [], views={'big': (self.q, ['name'])})
+        self.assertEqual(self.codes(table=reopened), ['001', '005', '006', '007', '008', '009'])
+        reopened = Table(self.db_uri, 'Test', 'code', ['days'], [], views={'big': (parse_filter('days > 8'), [])})
+        self.assertEqual(reopened.get_view('big'), [{'code': '001'}, {'code': '009'}])
+        readonly = Table(self.db_uri, 'Test', 'code', ['days'], [], readonly=True,
+                         views={'big': (parse_filter('days > 8'), [])})
+        self.assertEqual(self.codes(table=readonly), ['001', '009'])
+
+    def test_drop(self):
+        self.table.create_view('big', self.q)
+        self.table.drop_view('big')
+        self.assertEqual(self.table._db.scan_keys(b'v_'), [])
+        with self.assertRaises(ValueError):
+            self.table.get_view('big')
+
+
+if __name__ == '__main__':
+    unittest.main()